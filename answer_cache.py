@@ -0,0 +1,136 @@
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from bm25_index import normalize_text
+
+
+def normalize_query(query):
+    """
+    Normalizes a query for exact cache lookups: case, umlauts, punctuation and whitespace are ignored.
+
+    Args:
+        query (str): The user query.
+
+    Returns:
+        str: The normalized query.
+    """
+    return ' '.join(re.findall(r"[a-z0-9]+(?:[-/][a-z0-9]+)*", normalize_text(query)))
+
+
+class AnswerCache:
+    """
+    Persistent cache of generated answers, shared across sessions and restarts.
+
+    An exact hit requires the same normalized query and the same set of context page numbers, so a cached
+    answer is never served once a changed index retrieves different pages. An optional semantic hit accepts
+    a differently worded query for the same pages if the cosine similarity of the query embeddings reaches
+    the threshold. Entries expire after ttl seconds and the least recently used entries are evicted beyond
+    max_entries.
+
+    Args:
+        cache_path (str): Path to the SQLite file holding the cache.
+        ttl (float): Lifetime of an entry in seconds.
+        max_entries (int): Maximum number of cached answers.
+        semantic_threshold (float, optional): Minimum cosine similarity for a semantic hit; None disables them.
+    """
+
+    def __init__(self, cache_path='answer_cache.sqlite', ttl=7 * 24 * 3600, max_entries=1000, semantic_threshold=None):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.semantic_threshold = semantic_threshold
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS answers (
+            key TEXT PRIMARY KEY, pages TEXT, answer TEXT, embedding BLOB, created_at REAL, last_access REAL)""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS answers_pages ON answers (pages)")
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _pages_key(pages):
+        return ','.join(str(page) for page in sorted(set(pages)))
+
+    def _key(self, query, pages):
+        return hashlib.sha256(f"{normalize_query(query)}|{self._pages_key(pages)}".encode('utf-8')).hexdigest()
+
+    def get(self, query, pages, query_embedding=None):
+        """
+        Looks up the answer for a query whose context consists of the given pages.
+
+        Args:
+            query (str): The user query.
+            pages (List[int]): Page numbers of the context the answer would be generated from.
+            query_embedding (List[float], optional): Embedding of the query, needed for semantic hits.
+
+        Returns:
+            str or None: The cached answer, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl,))
+            key = self._key(query, pages)
+            row = self._connection.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.exact_hits += 1
+            elif self.semantic_threshold is not None and query_embedding is not None:
+                key, row = self._semantic_lookup(pages, query_embedding)
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE answers SET last_access = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            return row[0]
+
+    def _semantic_lookup(self, pages, query_embedding):
+        rows = self._connection.execute(
+            "SELECT key, answer, embedding FROM answers WHERE pages = ? AND embedding IS NOT NULL",
+            (self._pages_key(pages),)).fetchall()
+        if not rows:
+            return None, None
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        matrix = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+        similarities = matrix @ query_vector / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector) + 1e-12)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.semantic_threshold:
+            return None, None
+        self.semantic_hits += 1
+        return rows[best][0], (rows[best][1],)
+
+    def put(self, query, pages, answer, query_embedding=None):
+        """
+        Stores a generated answer and evicts the least recently used entries beyond max_entries.
+
+        Args:
+            query (str): The user query.
+            pages (List[int]): Page numbers of the context the answer was generated from.
+            answer (str): The generated answer.
+            query_embedding (List[float], optional): Embedding of the query, stored for semantic hits.
+        """
+        now = time.time()
+        embedding = np.asarray(query_embedding, dtype=np.float32).tobytes() if query_embedding is not None else None
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO answers (key, pages, answer, embedding, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (self._key(query, pages), self._pages_key(pages), answer, embedding, now, now))
+            self._connection.execute(
+                "DELETE FROM answers WHERE key NOT IN (SELECT key FROM answers ORDER BY last_access DESC LIMIT ?)",
+                (self.max_entries,))
+            self._connection.commit()
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Exact hits, semantic hits, misses and the number of stored entries.
+        """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            return {'exact_hits': self.exact_hits, 'semantic_hits': self.semantic_hits, 'misses': self.misses, 'entries': entries}
@@ -0,0 +1,406 @@
+import os
+import re
+import json
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+import datetime
+import subprocess
+import sys
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, AIMessageChunk
+import config
+from providers import set_provider
+from bm25_index import normalize_text
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic local stand-in for the Jina embeddings.
+
+    Every word is hashed into one of dim buckets with a random sign (feature hashing), so texts sharing
+    words get similar vectors and the vector search returns meaningful results. Every call sleeps for
+    latency seconds to model the API round trip.
+
+    Args:
+        dim (int): Dimension of the embeddings.
+        latency (float): Seconds every call takes.
+    """
+
+    def __init__(self, dim=256, latency=0.0):
+        self.dim = dim
+        self.latency = latency
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", normalize_text(text)):
+            bucket = zlib.crc32(word.encode('utf-8'))
+            vector[bucket % self.dim] += 1.0 if bucket & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._embed(text)
+
+    def embed_queries(self, texts):
+        # One round trip for the whole batch, like CachedEmbeddings.embed_queries
+        return self.embed_documents(texts)
+
+
+class FakeLLM:
+    """
+    Deterministic local stand-in for the Groq chat model, supporting invoke() and stream().
+
+    Args:
+        latency (float): Seconds until the full answer is available.
+        answer (str): The answer returned for every prompt.
+    """
+
+    def __init__(self, latency=0.0, answer="1"):
+        self.latency = latency
+        self.answer = answer
+
+    def _usage(self, prompt):
+        # Rough count, so the stand-in does not add tokenizer cost to the measurement
+        input_tokens = len(str(prompt)) // 4
+        output_tokens = len(self.answer) // 4 + 1
+        return {'input_tokens': input_tokens, 'output_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens}
+
+    def invoke(self, prompt):
+        if self.latency:
+            time.sleep(self.latency)
+        return AIMessage(content=self.answer, usage_metadata=self._usage(prompt))
+
+    def stream(self, prompt):
+        if self.latency:
+            time.sleep(self.latency)
+        yield AIMessageChunk(content=self.answer, usage_metadata=self._usage(prompt))
+
+
+def install_fakes(embedding_latency=0.0, llm_latency=0.0, dim=256):
+    """
+    Makes config.llm and config.text_embeddings resolve to the local stand-ins.
+
+    While they are installed, config.text_embeddings passes every call straight to the stand-in, so no fake
+    vector is read from or written to the embedding cache. The stand-ins are also returned so that the
+    benchmark can use them directly.
+
+    Returns:
+        Tuple[FakeEmbeddings, FakeLLM]: The installed stand-ins.
+    """
+    embeddings, llm = FakeEmbeddings(dim, embedding_latency), FakeLLM(llm_latency)
+    set_provider('embeddings', embeddings)
+    set_provider('llm', llm)
+    return embeddings, llm
+
+
+def scale_documents(documents, factor, page_offset):
+    """
+    Models a larger manual by repeating the documents, shifting the page numbers of every copy.
+
+    Args:
+        documents (List[Document]): The documents of the manual.
+        factor (int): Number of copies.
+        page_offset (int): Page number shift between two copies, at least the highest page number.
+
+    Returns:
+        List[Document]: The scaled corpus.
+    """
+    return [Document(page_content=doc.page_content,
+                     metadata={**doc.metadata, 'page_number': doc.metadata['page_number'] + copy * page_offset})
+            for copy in range(factor) for doc in documents]
+
+
+def build_corpus(directory, factor, backend, dim, documents_path='documents.json', sub_documents_path='sub_documents.json'):
+    """
+    Writes the document stores, the table store, the BM25 index and the vector store of a scaled corpus.
+
+    Returns:
+        float: Build time in seconds.
+    """
+    from data_prep import load_documents_from_json
+    from document_store import DocumentStore
+    from bm25_index import build_and_save_bm25_index
+    from product_codes import build_and_save_product_code_index
+    from table_store import TableStore
+    from indexing import assign_chunk_ids
+    from vector_index import FlatVectorIndex
+
+    start_time = time.perf_counter()
+    documents = load_documents_from_json(documents_path)
+    sub_documents = load_documents_from_json(sub_documents_path)
+    page_offset = max(doc.metadata['page_number'] for doc in documents + sub_documents) + 1
+    documents = scale_documents(documents, factor, page_offset)
+    sub_documents = scale_documents(sub_documents, factor, page_offset)
+
+    DocumentStore.write(documents, os.path.join(directory, 'doc_store', 'pages'))
+    DocumentStore.write(sub_documents, os.path.join(directory, 'doc_store', 'sub_documents'))
+    TableStore.from_sub_documents(sub_documents).save(os.path.join(directory, 'doc_store', 'tables.json'))
+    build_and_save_bm25_index(sub_documents, os.path.join(directory, 'bm25_index'))
+    build_and_save_product_code_index(sub_documents, os.path.join(directory, 'product_code_index.json'))
+
+    # The index is built without latency; only queries pay the modeled round trip
+    build_embeddings = FakeEmbeddings(dim)
+    chunk_ids = assign_chunk_ids(sub_documents)
+    if backend == 'flat':
+        FlatVectorIndex.build(sub_documents, chunk_ids, build_embeddings).save(os.path.join(directory, 'vector_store'))
+    else:
+        from langchain_chroma import Chroma
+        vectordb = Chroma(persist_directory=os.path.join(directory, 'vector_store'), embedding_function=build_embeddings)
+        for start in range(0, len(sub_documents), config.embedding_batch_size):
+            end = start + config.embedding_batch_size
+            vectordb.add_documents(sub_documents[start:end], ids=chunk_ids[start:end])
+    return time.perf_counter() - start_time
+
+
+def _percentiles(values):
+    values = np.asarray(values) * 1000
+    return {'p50': round(float(np.percentile(values, 50)), 3), 'p95': round(float(np.percentile(values, 95)), 3),
+            'p99': round(float(np.percentile(values, 99)), 3), 'mean': round(float(values.mean()), 3)}
+
+
+def run_scale(factor, queries, backend, dim, embeddings, workers, repeats, generate):
+    """
+    Builds a scaled corpus in a temporary directory and measures index load and query performance on it.
+
+    Args:
+        factor (int): Scale of the corpus relative to the manual.
+        queries (List[str]): The benchmark queries.
+        backend (str): Vector backend, 'flat' or 'chroma'.
+        dim (int): Dimension of the fake embeddings.
+        embeddings (FakeEmbeddings): Embedding stand-in used for queries.
+        workers (int): Number of queries processed concurrently.
+        repeats (int): Number of passes over the queries.
+        generate (bool): Whether to call the LLM stand-in after context building.
+
+    Returns:
+        dict: The measurements of this scale.
+    """
+    from query_engine import QueryEngine
+    from llm_utils import invoke_with_backoff
+    from prompts import RESPONSE_GENERATION_PROMPT
+
+    directory = tempfile.mkdtemp(prefix=f"benchmark_x{factor}_")
+    try:
+        build_s = build_corpus(directory, factor, backend, dim)
+
+        def load_engine():
+            return QueryEngine(vector_backend=backend, bm25_index_path=os.path.join(directory, 'bm25_index'),
+                               documents_path=None, sub_documents_path=None, embeddings=embeddings,
+                               vector_store_path=os.path.join(directory, 'vector_store'),
+                               document_store_dir=os.path.join(directory, 'doc_store'),
+                               product_code_index_path=os.path.join(directory, 'product_code_index.json'))
+
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        engine = load_engine()
+        load_s = time.perf_counter() - start_time
+        load_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        def run_query(query):
+            timings = {}
+            start_time = time.perf_counter()
+            docs = engine.retrieve(query)
+            timings['retrieval'] = time.perf_counter() - start_time
+            packed = engine.build_context(docs, query)
+            timings['context_build'] = time.perf_counter() - start_time - timings['retrieval']
+            if generate:
+                invoke_with_backoff(RESPONSE_GENERATION_PROMPT.format(context=packed.context, question=query))
+            timings['total'] = time.perf_counter() - start_time
+            timings['context_tokens'] = packed.tokens
+            return timings
+
+        # One untimed pass warms up the tokenizer and the page caches of the memory-mapped files
+        for query in queries:
+            run_query(query)
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(run_query, queries * repeats))
+        elapsed = time.perf_counter() - start_time
+
+        # The same queries retrieved as one batch, as evaluate.py does
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            engine.retrieve_many(queries)
+        batch_elapsed = time.perf_counter() - start_time
+
+        # Peak memory is measured in a separate sequential pass, since tracemalloc slows down every allocation
+        tracemalloc.start()
+        for query in queries:
+            run_query(query)
+        query_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return {
+            'sub_documents': len(engine.sub_documents),
+            'pages': len(engine.documents),
+            'build_s': round(build_s, 3),
+            'index_load_ms': round(load_s * 1000, 3),
+            'index_load_peak_mb': round(load_peak / 2 ** 20, 3),
+            'query_peak_mb': round(query_peak / 2 ** 20, 3),
+            'queries': len(results),
+            'throughput_qps': round(len(results) / elapsed, 3),
+            'batch_retrieval_qps': round(len(queries) * repeats / batch_elapsed, 3),
+            'latency_ms': {stage: _percentiles([result[stage] for result in results])
+                           for stage in ('retrieval', 'context_build', 'total')},
+            'mean_context_tokens': round(float(np.mean([result['context_tokens'] for result in results])), 1),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+ENTRY_MODULES = ['config', 'data_prep', 'generate_table_summary', 'indexing', 'query_engine', 'evaluate']
+
+
+def measure_import_times(modules=ENTRY_MODULES, runs=5):
+    """
+    Measures the startup cost of the entry points as the time to import them in a fresh interpreter.
+
+    Args:
+        modules (List[str]): The modules to import.
+        runs (int): Number of interpreter starts per module; the median is reported.
+
+    Returns:
+        dict: Mapping from module to the median import time in milliseconds, None if the import failed.
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    # The bare interpreter start is subtracted, so only the import itself is reported
+    commands = {None: 'pass', **{module: f"import {module}" for module in modules}}
+    medians = {}
+    for module, command in commands.items():
+        durations = []
+        for _ in range(runs):
+            start_time = time.perf_counter()
+            completed = subprocess.run([sys.executable, '-c', command], cwd=repo_dir, capture_output=True)
+            durations.append(time.perf_counter() - start_time)
+            if completed.returncode != 0:
+                print(f"Importing {module} failed: {completed.stderr.decode('utf-8', 'replace').strip().splitlines()[-1]}")
+                break
+        medians[module] = float(np.median(durations)) * 1000 if completed.returncode == 0 else None
+    interpreter_ms = medians.pop(None)
+    return {module: round(ms - interpreter_ms, 1) if ms is not None else None for module, ms in medians.items()}
+
+
+def current_commit():
+    """
+    Returns the short hash of HEAD, suffixed with '-dirty' if the working tree has uncommitted changes.
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f"{commit}-dirty" if dirty else commit
+
+
+def save_results(results, output_path, commit):
+    """
+    Stores the results of a run under its commit in a JSON file holding the runs of all commits.
+    """
+    runs = {}
+    if os.path.exists(output_path):
+        with open(output_path, 'r') as json_file:
+            runs = json.load(json_file)
+    runs[commit] = results
+    with open(output_path, 'w') as json_file:
+        json.dump(runs, json_file, indent=2)
+
+
+def compare_results(results, output_path, baseline):
+    """
+    Prints the relative change of throughput, latency and memory against the run of a baseline commit.
+    """
+    with open(output_path, 'r') as json_file:
+        baseline_results = json.load(json_file).get(baseline)
+    if baseline_results is None:
+        print(f"No results for baseline {baseline} in {output_path}.")
+        return
+
+    def change(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    for module, ms in results.get('imports', {}).items():
+        previous = baseline_results.get('imports', {}).get(module)
+        if ms is not None and previous is not None:
+            print(f"import {module} vs {baseline}: {ms:.0f} ms, {change(ms, previous)}")
+    for scale, measured in results['scales'].items():
+        previous = baseline_results['scales'].get(scale)
+        if previous is None:
+            continue
+        print(f"x{scale} vs {baseline}: throughput {change(measured['throughput_qps'], previous['throughput_qps'])}, "
+              f"p95 total {change(measured['latency_ms']['total']['p95'], previous['latency_ms']['total']['p95'])}, "
+              f"index load {change(measured['index_load_ms'], previous['index_load_ms'])}, "
+              f"query peak memory {change(measured['query_peak_mb'], previous['query_peak_mb'])}")
+
+
+def main():
+    """
+    Runs the offline benchmark over the scaled corpora and stores the results under the current commit.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark retrieval and context building offline with local stand-ins for the LLM and embeddings.")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], help="Corpus sizes as multiples of the manual.")
+    parser.add_argument('--backend', choices=['flat', 'chroma'], default='flat', help="Vector backend to benchmark.")
+    parser.add_argument('--workers', type=int, default=4, help="Number of queries processed concurrently.")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of timed passes over the queries.")
+    parser.add_argument('--dim', type=int, default=256, help="Dimension of the fake embeddings.")
+    parser.add_argument('--embedding-latency', type=float, default=0.0, help="Seconds every embedding call takes.")
+    parser.add_argument('--llm-latency', type=float, default=0.0, help="Seconds every LLM call takes.")
+    parser.add_argument('--generate', action='store_true', help="Call the LLM stand-in after context building.")
+    parser.add_argument('--import-runs', type=int, default=5, help="Interpreter starts per entry point for the import-time benchmark, 0 to skip it.")
+    parser.add_argument('--queries', default='questions_answers.csv', help="CSV file with the queries in the 'Frage' column.")
+    parser.add_argument('--output', default='benchmark_results.json', help="JSON file the results are stored in, keyed by commit.")
+    parser.add_argument('--baseline', help="Commit whose stored results the run is compared against.")
+    args = parser.parse_args()
+
+    embeddings, _ = install_fakes(args.embedding_latency, args.llm_latency, args.dim)
+
+    data = pd.read_csv(args.queries)
+    data.columns = data.columns.str.strip()
+    queries = data['Frage'].tolist()
+
+    commit = current_commit()
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'scales': {},
+    }
+    if args.import_runs:
+        results['imports'] = measure_import_times(runs=args.import_runs)
+        print("Import time per entry point: " + ", ".join(
+            f"{module} {ms:.0f} ms" for module, ms in results['imports'].items() if ms is not None))
+    for factor in args.scales:
+        print(f"Benchmarking x{factor} ...")
+        measured = run_scale(factor, queries, args.backend, args.dim, embeddings, args.workers, args.repeats, args.generate)
+        results['scales'][str(factor)] = measured
+        latency = measured['latency_ms']['total']
+        print(f"x{factor}: {measured['sub_documents']} sub-documents, index load {measured['index_load_ms']:.1f} ms "
+              f"({measured['index_load_peak_mb']:.1f} MB), {measured['throughput_qps']:.1f} queries/s "
+              f"({measured['batch_retrieval_qps']:.1f}/s batched retrieval), "
+              f"p50 {latency['p50']:.1f} ms, p95 {latency['p95']:.1f} ms, p99 {latency['p99']:.1f} ms, "
+              f"query peak memory {measured['query_peak_mb']:.1f} MB")
+
+    save_results(results, args.output, commit)
+    print(f"Results saved to {args.output} under {commit}.")
+    if args.baseline:
+        compare_results(results, args.output, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
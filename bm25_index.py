@@ -0,0 +1,379 @@
+import os
+import re
+import json
+import unicodedata
+from typing import Any, List
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from document_store import document_fingerprint
+
+
+# Hyphen/slash separated designations such as 'K-O-M4-V3', 'H-NN1' or 'XT/K'
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-/][a-z0-9]+)*")
+# German linking elements (Fugenelemente) allowed between the parts of a compound
+_LINKING_ELEMENTS = ('', 's', 'es', 'n', 'en')
+_MIN_PART_LENGTH = 4
+_MIN_COMPOUND_LENGTH = 2 * _MIN_PART_LENGTH
+
+
+def normalize_text(text):
+    """
+    Lowercases text and folds umlauts and accents to plain ASCII letters.
+
+    The OCR output of the manual has already lost its umlauts ('Warmedammelemente', 'fur'), so user queries
+    typed with umlauts have to be folded the same way to match.
+
+    Args:
+        text (str): The text to normalize.
+
+    Returns:
+        str: The normalized text.
+    """
+    text = text.lower().replace('ß', 'ss')
+    text = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def split_compound(word, lexicon):
+    """
+    Splits a German compound into two known parts, e.g. 'dehnfugenabstand' -> ('dehnfugen', 'abstand').
+
+    Both parts (after removing an optional linking element from the first one) must be in the lexicon.
+    The most balanced split is preferred, which avoids splitting off OCR fragments such as 'stande'.
+
+    Args:
+        word (str): A normalized, purely alphabetic word.
+        lexicon (set): The set of known words.
+
+    Returns:
+        list: The parts of the compound, or an empty list if no split was found.
+    """
+    if not lexicon or len(word) < _MIN_COMPOUND_LENGTH:
+        return []
+    best_parts, best_length = [], 0
+    for split in range(_MIN_PART_LENGTH, len(word) - _MIN_PART_LENGTH + 1):
+        head, tail = word[:split], word[split:]
+        if tail not in lexicon:
+            continue
+        for linking in _LINKING_ELEMENTS:
+            if linking and not head.endswith(linking):
+                continue
+            stem = head[:len(head) - len(linking)]
+            if len(stem) >= _MIN_PART_LENGTH and stem in lexicon and min(len(stem), len(tail)) > best_length:
+                best_parts, best_length = [stem, tail], min(len(stem), len(tail))
+    return best_parts
+
+
+def tokenize(text, lexicon=None):
+    """
+    Tokenizes text for the lexical index. The same function is used at index time and at query time.
+
+    Product codes are kept as a whole and additionally emitted as their segments and prefixes, so
+    'K-O-M4-V3' yields 'k-o-m4-v3', 'k-o', 'k-o-m4', 'k', 'o', 'm4' and 'v3' and matches queries for 'Typ K-O'.
+    Alphabetic words are additionally split into their compound parts when a lexicon is given.
+
+    Args:
+        text (str): The text to tokenize.
+        lexicon (set, optional): Known words used to split German compounds.
+
+    Returns:
+        List[str]: The list of tokens.
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(normalize_text(text)):
+        token = match.group()
+        segments = re.split(r"[-/]", token)
+        if len(segments) > 1:
+            tokens.append(token)
+            for end in range(2, len(segments)):
+                tokens.append('-'.join(segments[:end]))
+        for segment in segments:
+            tokens.append(segment)
+            if segment.isalpha():
+                tokens.extend(split_compound(segment, lexicon))
+    return tokens
+
+
+def build_lexicon(terms):
+    """
+    Selects the terms that can act as compound parts.
+
+    Args:
+        terms (iterable): Vocabulary terms.
+
+    Returns:
+        set: Alphabetic terms of at least the minimum part length.
+    """
+    return {term for term in terms if len(term) >= _MIN_PART_LENGTH and term.isalpha()}
+
+
+class BM25Index:
+    """
+    Okapi BM25 index stored as array-backed postings, with the term weights precomputed at index time.
+
+    The postings are laid out like a compressed sparse term x document matrix: the postings of term t are
+    doc_ids[indptr[t]:indptr[t + 1]] with their BM25 weights in weights[indptr[t]:indptr[t + 1]].
+    Every array is saved as a separate .npy file and memory-mapped on load. The fingerprint of the indexed
+    documents (document_store.document_fingerprint) is saved alongside, to detect a stale index.
+    """
+
+    def __init__(self, vocab, indptr, doc_ids, weights, doc_lengths, idf, k1=1.5, b=0.75, fingerprint=None):
+        self.vocab = vocab
+        self.term_to_id = {term: term_id for term_id, term in enumerate(vocab)}
+        self.lexicon = build_lexicon(vocab)
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.doc_lengths = doc_lengths
+        self.idf = idf
+        self.k1 = k1
+        self.b = b
+        self.fingerprint = fingerprint
+
+    @property
+    def num_docs(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def build(cls, texts, k1=1.5, b=0.75):
+        """
+        Tokenizes a corpus and computes its postings, document lengths, IDF and BM25 weights.
+
+        Args:
+            texts (List[str]): The texts of the documents to index.
+            k1 (float): BM25 term frequency saturation parameter.
+            b (float): BM25 length normalization parameter.
+
+        Returns:
+            BM25Index: The built index.
+        """
+        # The first pass collects the plain vocabulary that serves as lexicon for splitting compounds
+        lexicon = build_lexicon({token for text in texts for token in tokenize(text)})
+        tokenized = [tokenize(text, lexicon) for text in texts]
+
+        vocab = sorted({token for tokens in tokenized for token in tokens})
+        term_to_id = {term: term_id for term_id, term in enumerate(vocab)}
+
+        doc_lengths = np.array([len(tokens) for tokens in tokenized], dtype=np.float32)
+        avgdl = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+        # Count term frequencies per (term, document) pair
+        term_column, doc_column = [], []
+        for doc_id, tokens in enumerate(tokenized):
+            term_column.extend(term_to_id[token] for token in tokens)
+            doc_column.extend([doc_id] * len(tokens))
+        pairs = np.unique(np.array([term_column, doc_column], dtype=np.int64), axis=1, return_counts=True)
+        (pair_terms, pair_docs), tf = pairs
+        # np.unique sorts by term first, so the pairs are already grouped into postings lists
+        df = np.bincount(pair_terms, minlength=len(vocab))
+        indptr = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+
+        num_docs = len(texts)
+        idf = np.log((num_docs - df + 0.5) / (df + 0.5) + 1.0).astype(np.float32)
+        norm = k1 * (1 - b + b * doc_lengths[pair_docs] / avgdl)
+        weights = (idf[pair_terms] * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+
+        return cls(vocab, indptr, pair_docs.astype(np.int32), weights, doc_lengths, idf, k1, b)
+
+    def save(self, path):
+        """
+        Writes the index to a directory.
+
+        Args:
+            path (str): Directory where the index files are written.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ('indptr', 'doc_ids', 'weights', 'doc_lengths', 'idf'):
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, 'vocab.json'), 'w') as json_file:
+            json.dump(self.vocab, json_file)
+        with open(os.path.join(path, 'meta.json'), 'w') as json_file:
+            json.dump({'k1': self.k1, 'b': self.b, 'num_docs': self.num_docs, 'fingerprint': self.fingerprint}, json_file)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index written by save(), memory-mapping the postings arrays.
+
+        Args:
+            path (str): Directory containing the index files.
+
+        Returns:
+            BM25Index: The loaded index.
+        """
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+                  for name in ('indptr', 'doc_ids', 'weights', 'doc_lengths', 'idf')}
+        with open(os.path.join(path, 'vocab.json'), 'r') as json_file:
+            vocab = json.load(json_file)
+        with open(os.path.join(path, 'meta.json'), 'r') as json_file:
+            meta = json.load(json_file)
+        return cls(vocab, k1=meta['k1'], b=meta['b'], fingerprint=meta.get('fingerprint'), **arrays)
+
+    def query_term_ids(self, query):
+        """
+        Maps a query to the ids of its known terms. Repeated terms are kept, as in Okapi BM25.
+
+        Args:
+            query (str): The query text.
+
+        Returns:
+            np.ndarray: The term ids of the query.
+        """
+        return np.array([self.term_to_id[token] for token in tokenize(query, self.lexicon)
+                         if token in self.term_to_id], dtype=np.int64)
+
+    def get_scores(self, query):
+        """
+        Scores every document against a query.
+
+        The postings of all query terms are gathered into one array and summed per document with a
+        single np.bincount, instead of looping over documents.
+
+        Args:
+            query (str): The query text.
+
+        Returns:
+            np.ndarray: One BM25 score per document.
+        """
+        term_ids = self.query_term_ids(query)
+        if len(term_ids) == 0:
+            return np.zeros(self.num_docs, dtype=np.float32)
+        starts, ends = self.indptr[term_ids], self.indptr[term_ids + 1]
+        positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        return np.bincount(self.doc_ids[positions], weights=self.weights[positions], minlength=self.num_docs)
+
+    def top_k(self, query, k):
+        """
+        Returns the ids and scores of the k best matching documents, best first.
+
+        Documents that share no term with the query are not returned.
+
+        Args:
+            query (str): The query text.
+            k (int): Number of documents to return.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Document ids and their scores.
+        """
+        return self._select_top_k(self.get_scores(query), k)
+
+    def _select_top_k(self, scores, k):
+        k = min(k, self.num_docs)
+        if k <= 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        candidates = candidates[scores[candidates] > 0]
+        return candidates, scores[candidates]
+
+    def get_scores_many(self, queries):
+        """
+        Scores every document against a batch of queries in one pass.
+
+        This is the sparse product of the query x term count matrix with the term x document weight
+        matrix: the postings of all terms of all queries are gathered into one array, offset by
+        query * num_docs, and summed with a single np.bincount. Every row equals get_scores() of its query.
+
+        Args:
+            queries (List[str]): The query texts.
+
+        Returns:
+            np.ndarray: Scores of shape (queries, documents).
+        """
+        term_ids = [self.query_term_ids(query) for query in queries]
+        query_rows = np.repeat(np.arange(len(queries)), [len(ids) for ids in term_ids])
+        term_ids = np.concatenate(term_ids) if term_ids else np.array([], dtype=np.int64)
+        starts = self.indptr[term_ids].astype(np.int64)
+        lengths = self.indptr[term_ids + 1] - starts
+        # Postings of every (query, term) pair, laid out back to back in query and term order
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        positions = offsets + np.arange(offsets.size)
+        flat_ids = np.repeat(query_rows, lengths) * self.num_docs + self.doc_ids[positions]
+        scores = np.bincount(flat_ids, weights=self.weights[positions], minlength=len(queries) * self.num_docs)
+        return scores.reshape(len(queries), self.num_docs)
+
+    def top_k_many(self, queries, k, batch_size=32):
+        """
+        Returns the k best matching documents for each of a batch of queries, identical to top_k().
+
+        Args:
+            queries (List[str]): The query texts.
+            k (int): Number of documents per query.
+            batch_size (int): Number of queries scored at once, bounds the (queries x documents) score matrix.
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray]]: Document ids and their scores for every query.
+        """
+        results = []
+        for start in range(0, len(queries), batch_size):
+            scores = self.get_scores_many(queries[start:start + batch_size])
+            results.extend(self._select_top_k(row, k) for row in scores)
+        return results
+
+
+class PersistedBM25Retriever(BaseRetriever):
+    """
+    LangChain retriever backed by a persisted BM25Index, usable inside an EnsembleRetriever
+    as a drop-in for BM25Retriever.
+    """
+
+    index: BM25Index
+    # A list of Document objects or a DocumentStore, indexed by row
+    documents: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        doc_ids, _ = self.index.top_k(query, self.k)
+        return [self.documents[doc_id] for doc_id in doc_ids]
+
+    def batch_retrieve(self, queries):
+        """
+        Retrieves the documents for a batch of queries with one scoring pass, identical to invoking the
+        retriever for every query.
+
+        Args:
+            queries (List[str]): The query texts.
+
+        Returns:
+            List[List[Document]]: The documents of every query, best first.
+        """
+        return [[self.documents[doc_id] for doc_id in doc_ids] for doc_ids, _ in self.index.top_k_many(queries, self.k)]
+
+
+def build_and_save_bm25_index(sub_documents, path):
+    """
+    Builds the BM25 index over a list of sub-documents and writes it to disk.
+
+    Args:
+        sub_documents (List[Document] or DocumentStore): The sub-documents to index, in store order.
+        path (str): Directory where the index is written.
+
+    Returns:
+        BM25Index: The built index.
+    """
+    index = BM25Index.build([doc.page_content for doc in sub_documents])
+    index.fingerprint = document_fingerprint(sub_documents)
+    index.save(path)
+    print(f"BM25 index with {len(index.vocab)} terms saved at {path}")
+    return index
+
+
+def load_bm25_retriever(path, sub_documents, k=4):
+    """
+    Loads the persisted BM25 index as a retriever, building and saving it first if it does not exist
+    or no longer matches the sub-documents.
+
+    Args:
+        path (str): Directory of the persisted index.
+        sub_documents (List[Document] or DocumentStore): The indexed sub-documents, in store order.
+        k (int): Number of documents returned per query.
+
+    Returns:
+        PersistedBM25Retriever: The lexical retriever.
+    """
+    index = BM25Index.load(path) if os.path.exists(os.path.join(path, 'meta.json')) else None
+    if index is None or index.num_docs != len(sub_documents) or index.fingerprint != document_fingerprint(sub_documents):
+        index = build_and_save_bm25_index(sub_documents, path)
+    return PersistedBM25Retriever(index=index, documents=sub_documents, k=k)
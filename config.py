@@ -1,35 +1,63 @@
 import os
-from langchain_openai import AzureChatOpenAI
-from langchain_community.embeddings import JinaEmbeddings
-from langchain_groq import ChatGroq
-
 from dotenv import load_dotenv
-from langchain_openai import AzureOpenAIEmbeddings
-from langchain_groq import ChatGroq
+from providers import LazyClient, resolved_provider
+from embedding_cache import CachedEmbeddings
 
-# load_dotenv()
-# aryn_api_key = os.getenv('aryn_api_key')
-# jina_api_key = os.getenv('jina_api_key')
-# groq_api_key = os.getenv('groq_api_key')
+# API keys are read from the environment or a .env file next to the app
+load_dotenv()
+aryn_api_key = os.getenv('aryn_api_key')
+jina_api_key = os.getenv('jina_api_key')
+groq_api_key = os.getenv('groq_api_key')
 
 manual_path = 'technical_manual.pdf'     ## solution manual pdf path
 summary_filename = 'table_summaries.json'  ## generated summaries of the tables present in the pdf
+partition_shard_pages = 50                 ## Pages per request when partitioning the pdf, shards are partitioned concurrently
+partition_workers = 4                      ## Number of shards partitioned concurrently
+partition_max_retries = 3                  ## Retries of a failed shard before ingestion is aborted
+partition_cache_path = "./partition_cache"  ## raw partition results, keyed by pdf content hash and partition options
+corpus_path = "./corpus"                   ## per-manual index shards built by corpus.py; the app serves them when the directory holds any
+corpus_build_workers = 2                   ## Number of manuals indexed concurrently
+corpus_memory_mb = 1024                    ## Size on disk of the loaded manual shards, least recently used shards are unloaded beyond it
+corpus_fanout_workers = 8                  ## Number of manuals searched concurrently for a query that is not routed to specific manuals
+document_store_path = "./doc_store"         ## directory of the memory-mapped page and sub-document stores
 vector_store_path = "./fox_base_task"       ## persistant directory for vector store      #"./fox_base_task" 
+vector_backend = 'chroma'                  ## Vector store backend: 'chroma' (persistent HNSW store) or 'flat' (exact NumPy index)
+flat_index_path = "./flat_index"            ## persistant directory for the flat NumPy vector index
+bm25_index_path = "./bm25_index"            ## persistant directory for the precomputed BM25 index
+embedding_batch_size = 64                  ## Number of chunks embedded and upserted per request during indexing
+embedding_cache_path = 'embedding_cache.sqlite'  ## local cache of computed embeddings, keyed by model name and text hash
+answer_cache_path = 'answer_cache.sqlite'  ## persistent cache of generated answers shared across sessions
+answer_cache_ttl = 7 * 24 * 3600           ## Lifetime of a cached answer in seconds
+answer_cache_max_entries = 1000            ## Maximum number of cached answers, least recently used are evicted
+answer_cache_semantic_threshold = 0.95     ## Cosine similarity of query embeddings for a near-duplicate hit, None to disable
+judge_cache_path = 'judge_cache.sqlite'    ## evaluation scores of the LLM judge, keyed by a hash of query, reference and generated answer
 Embedding_model=  'jina-embeddings-v3'     ## Name of the open source embedding model used
 llm_name = "llama-3.3-70b-versatile"       ## Name of the open source LLM used
+llm_provider = os.getenv('llm_provider', 'groq')                ## LLM backend registered in providers.py: 'groq' or 'azure'
+embedding_provider = os.getenv('embedding_provider', 'jina')    ## Embedding backend registered in providers.py: 'jina' or 'azure'
+http_pool_size = 16                        ## Connections kept open per backend, at least the number of concurrent workers
 k_value = 15                               ## Number of chunks to retrieve
+retriever_weights = [0.5, 0.5]             ## Weights of the BM25 and the vector search results in the rank fusion
+rrf_k = 60                                 ## Rank offset of the reciprocal rank fusion, larger values flatten the ranking
+retrieval_dedupe_pages = True              ## Keep only the best ranked chunk of every page after fusion
+retrieval_eval_cutoffs = [1, 3, 5, 10]     ## Page cutoffs n of the recall@n reported by the retrieval-only evaluation
+product_code_index_path = "./product_code_index.json"  ## inverted index from product/type designations to pages
+product_code_max_pages = 3                 ## Queries whose designations appear on at most this many pages skip the ensemble search
+tracing_enabled = False                    ## Record per-stage latency, token counts and context size of every request
+trace_path = 'traces.jsonl'                ## JSON lines file the recorded traces are appended to
+llm_prompt_token_budgets = {               ## Prompt token budget per LLM, leaves room for the answer within the request limits
+    "llama-3.3-70b-versatile": 5000,
+}
+table_max_rows = 8                         ## Rows kept per table in the context when some rows match the query, None passes whole tables
+prompt_token_budget = llm_prompt_token_budgets.get(llm_name, 4000)
 
-jina_api_key = 'set here'
-groq_api_key = 'set here'
-aryn_api_key = 'set here'
-
-
-llm = ChatGroq(
-    temperature=0, 
-    groq_api_key=groq_api_key, 
-    model_name=llm_name
-)
+# Clients are created by providers.py on first use, so importing config stays cheap
+llm = LazyClient('llm')
 
-text_embeddings = JinaEmbeddings(
-    jina_api_key=jina_api_key, model_name=Embedding_model
+text_embeddings = CachedEmbeddings(
+    LazyClient('embeddings'),
+    model_name=Embedding_model,
+    provider=lambda: resolved_provider('embeddings'),
+    cache_path=embedding_cache_path,
+    batch_size=embedding_batch_size
 )
@@ -0,0 +1,170 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List
+from config import prompt_token_budget
+from tracing import record
+
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Safety margin for the difference between the estimating tokenizer and the model's own tokenizer
+_TOKEN_ESTIMATE_MARGIN = 1.1
+_SEPARATOR = "\n\n"
+
+
+@lru_cache(maxsize=None)
+def _get_encoding():
+    """
+    Loads the tokenizer used to estimate token counts, or returns None if it is not available.
+
+    Llama 3 uses a tiktoken-based BPE vocabulary, so cl100k_base gives a close estimate of its token counts.
+    The encoding file is downloaded on first use, which fails on machines without internet access.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        print(f"tiktoken encoding unavailable, estimating tokens from characters: {e}")
+        return None
+
+
+def token_counter_name():
+    """
+    Returns how count_tokens() counts, so that reported token figures can say whether they are estimates.
+
+    Returns:
+        str: 'cl100k_base', or 'characters / 4' when the tiktoken encoding is not available.
+    """
+    return 'cl100k_base' if _get_encoding() is not None else 'characters / 4'
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """
+    Estimates the number of tokens the LLM will see for a text.
+
+    Uses tiktoken when it is installed and falls back to the common 4 characters per token heuristic.
+    Results are cached, since the same pages are counted again and again across queries.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = len(encoding.encode(text, disallowed_special=()))
+    else:
+        tokens = len(text) // 4 + 1
+    return int(tokens * _TOKEN_ESTIMATE_MARGIN)
+
+
+def context_token_budget(prompt_template, question, budget=prompt_token_budget):
+    """
+    Computes how many tokens are left for the context once the prompt template and the question are filled in.
+
+    Args:
+        prompt_template (str): Prompt template with {context} and {question} placeholders.
+        question (str): The user query.
+        budget (int): Total prompt token budget of the model named in config.llm_name.
+
+    Returns:
+        int: The number of tokens available for the context.
+    """
+    return max(0, budget - count_tokens(prompt_template.format(context='', question=question)))
+
+
+@dataclass
+class PackedContext:
+    """
+    Result of packing retrieved pages into the context token budget.
+    """
+    context: str
+    pages: List = field(default_factory=list)
+    dropped_pages: List = field(default_factory=list)
+    tokens: int = 0
+    unpacked_tokens: int = 0
+
+    @property
+    def tokens_saved(self):
+        """Tokens saved compared to pasting the full page once per retrieved chunk."""
+        return self.unpacked_tokens - self.tokens
+
+
+def page_key(doc):
+    """
+    Identifies the page of a retrieved document: its page number, or (manual, page number) for documents
+    retrieved from a corpus of several manuals (see corpus.py).
+    """
+    manual = doc.metadata.get('manual')
+    return doc.metadata['page_number'] if manual is None else (manual, doc.metadata['page_number'])
+
+
+def format_page_reference(page):
+    """
+    Formats a page key from page_key() as 'Page 54' or, with a manual, 'Page 54 (manual)'.
+    """
+    if isinstance(page, tuple):
+        manual, page_number = page
+        return f"Page {page_number} ({manual})"
+    return f"Page {page}"
+
+
+def _page_section(page, page_to_content):
+    if page in page_to_content:
+        return f"{format_page_reference(page)}: {page_to_content[page]}"
+    return f"{format_page_reference(page)}: Unknown Content"
+
+
+def pack_context(docs, page_to_content, budget):
+    """
+    Builds the LLM context from retrieved sub-documents within a token budget.
+
+    Pages are deduplicated and kept in the fused rank order of the retrieved chunks, then packed greedily:
+    each page is added if it still fits into the budget, otherwise it is skipped and the next one is tried.
+    The best ranked page is always included and is truncated if it alone exceeds the budget, so the
+    prompt never overflows and a single generation call is enough.
+
+    Args:
+        docs (List[Document]): Retrieved sub-documents, best first.
+        page_to_content (dict): Mapping from page number to page content (see data_prep.build_page_map or DocumentStore.pages),
+            or from (manual, page number) for documents of several manuals.
+        budget (int): Maximum number of context tokens.
+
+    Returns:
+        PackedContext: The packed context with the included and dropped pages and its token counts.
+    """
+    separator_tokens = count_tokens(_SEPARATOR)
+    ranked_pages = list(dict.fromkeys(page_key(doc) for doc in docs))
+
+    # What prepare_context_for_generation would have sent: one full page per retrieved chunk
+    unpacked_tokens = sum(count_tokens(_page_section(page_key(doc), page_to_content)) + separator_tokens
+                          for doc in docs)
+
+    sections, pages, dropped_pages, used_tokens = [], [], [], 0
+    for page_num in ranked_pages:
+        section = _page_section(page_num, page_to_content)
+        section_tokens = count_tokens(section) + separator_tokens
+        if used_tokens + section_tokens <= budget:
+            sections.append(section)
+            pages.append(page_num)
+            used_tokens += section_tokens
+        elif not sections:
+            # Keep as much of the top hit as fits instead of dropping it
+            section = section[:int(len(section) * budget / section_tokens)]
+            sections.append(section)
+            pages.append(page_num)
+            used_tokens += count_tokens(section) + separator_tokens
+        else:
+            dropped_pages.append(page_num)
+
+    context = _SEPARATOR.join(sections)
+    tokens = count_tokens(context) if context else 0
+    record(context_chars=len(context), context_pages=len(pages), context_tokens=tokens, tokens_saved=unpacked_tokens - tokens)
+    return PackedContext(context=context, pages=pages, dropped_pages=dropped_pages,
+                         tokens=tokens, unpacked_tokens=unpacked_tokens)
@@ -0,0 +1,432 @@
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import contextvars
+from collections import OrderedDict
+from langchain_core.documents import Document
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from query_engine import QueryEngine
+from hybrid_retriever import reciprocal_rank_fusion
+from context_builder import pack_context, context_token_budget, page_key
+from product_codes import ProductCodeIndex, extract_query_codes
+from bm25_index import normalize_text
+from partition_cache import file_hash
+from prompts import CORPUS_RESPONSE_GENERATION_PROMPT
+from tracing import span, record
+from config import text_embeddings, vector_backend, k_value, rrf_k
+from config import corpus_path, corpus_build_workers, corpus_memory_mb, corpus_fanout_workers
+
+
+_MANIFEST = 'manual.json'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # Separate from the pool of the hybrid retrievers, whose dense legs the fanned out searches wait on
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=corpus_fanout_workers, thread_name_prefix='corpus_fanout')
+        return _executor
+
+
+def manual_id(pdf_path):
+    """
+    Derives the identifier of a manual from its file name, e.g. 'Schöck Isokorb XT.pdf' -> 'schock-isokorb-xt'.
+
+    Args:
+        pdf_path (str): Path to the PDF file of the manual.
+
+    Returns:
+        str: The identifier, used as the name of the manual's shard directory and in page references.
+    """
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    return re.sub(r"[^a-z0-9]+", '-', normalize_text(stem)).strip('-')
+
+
+def shard_paths(manual, corpus_dir=corpus_path):
+    """
+    Returns the paths of the artifacts of a manual's shard, laid out like the single-manual artifacts.
+
+    Args:
+        manual (str): The manual identifier.
+        corpus_dir (str): Directory of the corpus.
+
+    Returns:
+        dict: Paths of the shard directory, the stores, the indexes, the vector store and the table summaries.
+    """
+    directory = os.path.join(corpus_dir, manual)
+    return {
+        'directory': directory,
+        'document_store_dir': os.path.join(directory, 'doc_store'),
+        'bm25_index_path': os.path.join(directory, 'bm25_index'),
+        'product_code_index_path': os.path.join(directory, 'product_code_index.json'),
+        'vector_store_path': os.path.join(directory, 'vector_store'),
+        'summary_filename': os.path.join(directory, 'table_summaries.json'),
+    }
+
+
+def _directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+def build_shard(pdf_path, corpus_dir=corpus_path, force_refresh=False, rebuild=False):
+    """
+    Indexes one manual into its own shard: document, table and sub-document stores, BM25 and product code
+    indexes, vector store and table summaries, followed by a manifest.
+
+    A shard whose manifest matches the content hash of the PDF and the vector backend is left as it is.
+
+    Args:
+        pdf_path (str): Path to the PDF file of the manual.
+        corpus_dir (str): Directory of the corpus.
+        force_refresh (bool): Partition the PDF again instead of replaying the cached partition results.
+        rebuild (bool): Index the manual even if its shard is up to date.
+
+    Returns:
+        dict: The manifest of the shard.
+    """
+    # Imported on demand, indexing pulls in the partitioning and summarization clients
+    from indexing import prepare_documents_and_vector_store
+    from document_store import DocumentStore
+
+    manual = manual_id(pdf_path)
+    paths = shard_paths(manual, corpus_dir)
+    manifest_path = os.path.join(paths['directory'], _MANIFEST)
+    pdf_hash = file_hash(pdf_path)
+    if not rebuild and not force_refresh and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as json_file:
+            manifest = json.load(json_file)
+        if manifest['pdf_hash'] == pdf_hash and manifest['vector_backend'] == vector_backend:
+            print(f"Manual {manual} is up to date.")
+            return manifest
+
+    start_time = time.perf_counter()
+    os.makedirs(paths['directory'], exist_ok=True)
+    prepare_documents_and_vector_store(pdf_path, paths['summary_filename'], force_refresh=force_refresh,
+                                       document_store_dir=paths['document_store_dir'], bm25_index_path=paths['bm25_index_path'],
+                                       product_code_index_path=paths['product_code_index_path'],
+                                       vector_store_path=paths['vector_store_path'])
+
+    manifest = {
+        'manual': manual,
+        'title': os.path.splitext(os.path.basename(pdf_path))[0],
+        'source': pdf_path,
+        'pdf_hash': pdf_hash,
+        'vector_backend': vector_backend,
+        'pages': len(DocumentStore(os.path.join(paths['document_store_dir'], 'pages'))),
+        # The router of the corpus reads the designations of every manual without loading its shard
+        'codes': sorted(ProductCodeIndex.load(paths['product_code_index_path']).code_pages),
+    }
+    # Written last, so an interrupted build is picked up again by the next run
+    with open(f"{manifest_path}.tmp", 'w') as json_file:
+        json.dump(manifest, json_file, ensure_ascii=False)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    print(f"Manual {manual} indexed in {time.perf_counter() - start_time:.1f}s.")
+    return manifest
+
+
+def build_corpus(pdf_paths, corpus_dir=corpus_path, workers=corpus_build_workers, force_refresh=False, rebuild=False):
+    """
+    Indexes several manuals into their shards, concurrently. Every shard is built independently, so a
+    failing manual does not affect the others and only new or changed manuals are indexed again.
+
+    Args:
+        pdf_paths (List[str]): Paths to the PDF files of the manuals.
+        corpus_dir (str): Directory of the corpus.
+        workers (int): Number of manuals indexed concurrently.
+        force_refresh (bool): Partition the PDFs again instead of replaying the cached partition results.
+        rebuild (bool): Index every manual even if its shard is up to date.
+
+    Returns:
+        dict: Mapping from manual identifier to the manifest of every successfully built shard.
+    """
+    manuals = {}
+    for pdf_path in pdf_paths:
+        manual = manual_id(pdf_path)
+        if manual in manuals:
+            raise ValueError(f"{pdf_path} and {manuals[manual]} map to the same manual identifier '{manual}'")
+        manuals[manual] = pdf_path
+
+    manifests, failed = {}, []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(build_shard, pdf_path, corpus_dir, force_refresh, rebuild): manual
+                   for manual, pdf_path in manuals.items()}
+        for future in as_completed(futures):
+            manual = futures[future]
+            try:
+                manifests[manual] = future.result()
+            except Exception as e:
+                print(f"Failed to index manual {manual}: {e}")
+                failed.append(manual)
+
+    print(f"Corpus at {corpus_dir}: {len(manifests)} manuals indexed" + (f", {len(failed)} failed: {failed}" if failed else "."))
+    return manifests
+
+
+def read_manifests(corpus_dir=corpus_path):
+    """
+    Reads the manifests of the built shards of a corpus.
+
+    Args:
+        corpus_dir (str): Directory of the corpus.
+
+    Returns:
+        dict: Mapping from manual identifier to its manifest, with the size of the shard on disk under 'size_mb'.
+    """
+    manifests = {}
+    if not os.path.isdir(corpus_dir):
+        return manifests
+    for name in sorted(os.listdir(corpus_dir)):
+        manifest_path = os.path.join(corpus_dir, name, _MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as json_file:
+                manifest = json.load(json_file)
+            manifest['size_mb'] = _directory_size(os.path.join(corpus_dir, name)) / 2 ** 20
+            manifests[manifest['manual']] = manifest
+    return manifests
+
+
+class Corpus:
+    """
+    Retrieval over a corpus of manuals, each indexed into its own shard by build_corpus().
+
+    Every shard is served by its own QueryEngine, loaded on first use. Once the loaded shards exceed
+    max_memory_mb, estimated from their size on disk, the least recently used ones are unloaded.
+
+    A query is routed to the manuals that contain its product or type designations (or their longest known
+    prefix) or whose title it mentions; any other query is fanned out to all manuals concurrently. The results of
+    several manuals are merged by reciprocal rank fusion. Retrieved documents carry their manual in the 'manual'
+    metadata, so context sections and page references name it.
+
+    The corpus has the interface of QueryEngine (retrieve, retrieve_many, build_context, reload), so the app
+    can serve either.
+
+    Args:
+        corpus_dir (str): Directory of the corpus.
+        max_memory_mb (float): Size on disk of the shards kept loaded.
+        embeddings: Embedding function used for query embedding.
+    """
+
+    # Generation prompt matching the page labels of build_context()
+    response_prompt = CORPUS_RESPONSE_GENERATION_PROMPT
+
+    def __init__(self, corpus_dir=corpus_path, max_memory_mb=corpus_memory_mb, embeddings=text_embeddings):
+        self.corpus_dir = corpus_dir
+        self.max_memory_mb = max_memory_mb
+        self.embeddings = embeddings
+        self._lock = threading.RLock()
+        self._engines = OrderedDict()
+        # One lock per manual being loaded, so a shard loads once while queries for other shards go on
+        self._loading = {}
+        self._generation = 0
+        self.reload()
+
+    def reload(self):
+        """
+        Re-reads the manifests of the shards and unloads all loaded shards, which are loaded again on their next use.
+        """
+        manifests = read_manifests(self.corpus_dir)
+        code_manuals = {}
+        for manual, manifest in manifests.items():
+            for code in manifest['codes']:
+                code_manuals.setdefault(code, []).append(manual)
+        with self._lock:
+            self.manifests = manifests
+            self.code_manuals = code_manuals
+            self._engines = OrderedDict()
+            # Shards still loading from the previous manifests are not kept
+            self._generation += 1
+        print(f"Corpus with {len(manifests)} manuals and {sum(manifest['pages'] for manifest in manifests.values())} pages.")
+
+    def engine(self, manual):
+        """
+        Returns the QueryEngine of a manual's shard, loading it and unloading the least recently used shards if needed.
+
+        Args:
+            manual (str): The manual identifier.
+
+        Returns:
+            QueryEngine: The engine of the shard.
+        """
+        with self._lock:
+            engine = self._loaded(manual)
+            if engine is not None:
+                return engine
+            manifest, generation = self.manifests[manual], self._generation
+            loading_lock = self._loading.setdefault(manual, threading.Lock())
+
+        # The shard is loaded outside the corpus lock, only queries for the same manual wait for it
+        with loading_lock:
+            with self._lock:
+                engine = self._loaded(manual)
+                if engine is not None:
+                    return engine
+            paths = shard_paths(manual, self.corpus_dir)
+            engine = QueryEngine(vector_backend=manifest['vector_backend'], bm25_index_path=paths['bm25_index_path'],
+                                 documents_path=None, sub_documents_path=None, embeddings=self.embeddings,
+                                 vector_store_path=paths['vector_store_path'], document_store_dir=paths['document_store_dir'],
+                                 product_code_index_path=paths['product_code_index_path'])
+            with self._lock:
+                self._loading.pop(manual, None)
+                if generation != self._generation:
+                    return engine
+                self._engines[manual] = engine
+                # Queries that still hold an unloaded engine finish on it; it is freed afterwards
+                while len(self._engines) > 1 and sum(self.manifests[loaded]['size_mb'] for loaded in self._engines) > self.max_memory_mb:
+                    unloaded, _ = self._engines.popitem(last=False)
+                    print(f"Unloaded manual {unloaded}.")
+            return engine
+
+    def _loaded(self, manual):
+        # Called with the corpus lock held
+        engine = self._engines.get(manual)
+        if engine is not None:
+            self._engines.move_to_end(manual)
+        return engine
+
+    def route(self, query):
+        """
+        Selects the manuals a query is searched in.
+
+        Args:
+            query (str): The user query.
+
+        Returns:
+            List[str]: The manuals containing the designations of the query or named by it, or all manuals.
+        """
+        with self._lock:
+            manifests, code_manuals = self.manifests, self.code_manuals
+        manuals = set()
+        for code in extract_query_codes(query):
+            segments = code.split('-')
+            # Variants such as 'K-O-M4-V3' fall back to their longest known prefix, down to two segments
+            for end in range(len(segments), min(2, len(segments)) - 1, -1):
+                found = code_manuals.get('-'.join(segments[:end]))
+                if found:
+                    manuals.update(found)
+                    break
+        # Manuals named in the query, e.g. 'schock isokorb xt' for the manual 'schock-isokorb-xt'
+        query_words = f" {re.sub(r'[^a-z0-9]+', ' ', normalize_text(query))} "
+        manuals.update(manual for manual in manifests if f" {manual.replace('-', ' ')} " in query_words)
+        return sorted(manuals) or sorted(manifests)
+
+    @staticmethod
+    def _tag(manual, docs):
+        # Copies, the flat vector index hands out the same Document objects for every query
+        return [Document(page_content=doc.page_content, metadata={**doc.metadata, 'manual': manual}) for doc in docs]
+
+    def _merge(self, result_lists):
+        if len(result_lists) == 1:
+            return result_lists[0]
+        return reciprocal_rank_fusion(result_lists, [1.0] * len(result_lists), rrf_k)
+
+    def retrieve(self, query, k=k_value):
+        """
+        Retrieves the sub-documents relevant to a query from the manuals it is routed to.
+
+        Args:
+            query (str): The user query.
+            k (int): Number of chunks to retrieve from the vector store of every manual.
+
+        Returns:
+            List[Document]: The retrieved sub-documents, best first, with their manual in the 'manual' metadata.
+        """
+        manuals = self.route(query)
+        record(manuals=manuals)
+        if not manuals:
+            return []
+
+        def search(manual):
+            return self._tag(manual, self.engine(manual).retrieve(query, k=k))
+
+        if len(manuals) == 1:
+            return search(manuals[0])
+        # Every search runs in a copy of the current context, so it records into the active trace
+        with span('fanout'):
+            futures = [_get_executor().submit(contextvars.copy_context().run, search, manual) for manual in manuals]
+            return self._merge([future.result() for future in futures])
+
+    def retrieve_many(self, queries, k=k_value):
+        """
+        Retrieves the sub-documents relevant to each of a batch of queries, with the same results as retrieve().
+
+        The queries are grouped by manual and every manual retrieves for its queries in one batch
+        (see QueryEngine.retrieve_many); manuals are processed one after the other, so each is loaded once.
+
+        Args:
+            queries (List[str]): The user queries.
+            k (int): Number of chunks to retrieve from the vector store of every manual.
+
+        Returns:
+            List[List[Document]]: The retrieved sub-documents of every query, best first.
+        """
+        routes = [self.route(query) for query in queries]
+        manual_queries = {}
+        for index, manuals in enumerate(routes):
+            for manual in manuals:
+                manual_queries.setdefault(manual, []).append(index)
+
+        results = {}
+        for manual, indices in manual_queries.items():
+            manual_results = self.engine(manual).retrieve_many([queries[index] for index in indices], k=k)
+            for index, docs in zip(indices, manual_results):
+                results[(index, manual)] = self._tag(manual, docs)
+        return [self._merge([results[(index, manual)] for manual in manuals]) for index, manuals in enumerate(routes)]
+
+    def build_context(self, docs, query, prompt_template=CORPUS_RESPONSE_GENERATION_PROMPT):
+        """
+        Expands retrieved sub-documents into the page-level context passed to the LLM, like
+        QueryEngine.build_context, with sections labeled 'Page X (manual):'.
+
+        Args:
+            docs (List[Document]): Retrieved sub-documents, best first, with their manual in the 'manual' metadata.
+            query (str): The user query the prompt will be filled with.
+            prompt_template (str): The generation prompt template.
+
+        Returns:
+            PackedContext: The context string and its token counts; its pages are (manual, page number) pairs.
+        """
+        with span('context_build'):
+            page_maps, page_to_content = {}, {}
+            for doc in docs:
+                manual, page_number = page_key(doc)
+                if manual not in page_maps:
+                    page_maps[manual] = self.engine(manual).page_map(query)
+                content = page_maps[manual].get(page_number)
+                if content is not None:
+                    page_to_content[(manual, page_number)] = content
+            return pack_context(docs, page_to_content, context_token_budget(prompt_template, query))
+
+
+def open_query_engine(corpus_dir=corpus_path):
+    """
+    Opens the retrieval stack of the app: the corpus if corpus_dir holds built manuals, otherwise the
+    QueryEngine of the single manual configured in config.py.
+
+    Args:
+        corpus_dir (str): Directory of the corpus.
+
+    Returns:
+        Corpus or QueryEngine: The retrieval stack.
+    """
+    if read_manifests(corpus_dir):
+        return Corpus(corpus_dir)
+    return QueryEngine()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index product manuals into a multi-manual corpus, one shard per manual.")
+    parser.add_argument('pdf_paths', nargs='+', help="PDF files of the manuals.")
+    parser.add_argument('--corpus', default=corpus_path, help="Directory of the corpus.")
+    parser.add_argument('--workers', type=int, default=corpus_build_workers, help="Number of manuals indexed concurrently.")
+    parser.add_argument('--refresh-partitions', action='store_true', help="Partition the PDFs again, ignoring cached partition results.")
+    parser.add_argument('--rebuild', action='store_true', help="Index every manual even if its shard is up to date.")
+    args = parser.parse_args()
+
+    build_corpus(args.pdf_paths, args.corpus, args.workers, force_refresh=args.refresh_partitions, rebuild=args.rebuild)
@@ -1,12 +1,17 @@
 import os
 import pandas as pd
 from dotenv import load_dotenv
-import aryn_sdk
-from aryn_sdk.partition import partition_file, tables_to_pandas
 from langchain_core.documents import Document
-from typing import List, Tuple
+from typing import Tuple
 import json
-from config import aryn_api_key
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from config import aryn_api_key, document_store_path, partition_shard_pages, partition_workers, partition_max_retries
+from config import partition_cache_path
+from document_store import DocumentStore
+from partition_cache import PartitionCache, file_hash
+from table_store import TableStore
 
 
 def save_documents_to_json(documents, file_path):
@@ -36,82 +41,238 @@ def save_documents_to_json(documents, file_path):
         
         
 
-def process_pdf(file_name: str) -> Tuple[List[Document], List[Document]]:
+ELEMENT_TYPES_TO_REMOVE = {'Footnote', 'Page-footer', 'Page-header', 'Caption', 'Image'}
+PARTITION_OPTIONS = {'extract_table_structure': True, 'use_ocr': True}
+
+partition_cache = PartitionCache(partition_cache_path)
+
+
+def count_pdf_pages(file_name):
     """
-    Processes a PDF file to extract text and tables, filtering out non-essential elements, and creates Document objects
-    for both full-page content and individual elements.
-    
+    Returns the number of pages of a PDF file without partitioning it.
+
     Args:
-    file_name (str): The path to the PDF file to be processed.
+        file_name (str): The path to the PDF file.
 
     Returns:
-    Tuple[List[Document], List[Document]]: A tuple containing two lists of Document objects. 
-    The first list contains documents aggregated by page.
-        The second list contains sub-documents for each individual element, including tables and text elements.
+        int: The number of pages.
     """
-    # Load PDF file
-    with open(file_name, 'rb') as file:
-        partitioned_file = partition_file(file, aryn_api_key, extract_table_structure=True, use_ocr=True)
-        
-    filtered_file = partitioned_file.copy()
-
-    # Filter out unnecessary elements
-    # element_types_to_remove = {'Caption', 'Footnote', 'Image', 'Page-footer', 'Page-header', 'Section-header'}
-    element_types_to_remove = {'Footnote', 'Page-footer', 'Page-header','Caption','Image'}
-    filtered_file['elements'] = [
-        element for element in partitioned_file['elements'] 
-        if element['type'] not in element_types_to_remove
-    ]
-    
-    # Extract tables into pandas DataFrames
+    from pypdf import PdfReader
+    return len(PdfReader(file_name).pages)
+
+
+def page_ranges(num_pages, shard_pages):
+    """
+    Splits the pages of a document into consecutive shards.
+
+    Args:
+        num_pages (int): The number of pages.
+        shard_pages (int): The maximum number of pages per shard.
+
+    Returns:
+        List[Tuple[int, int]]: First and last page (1-based, inclusive) of every shard.
+    """
+    return [(start, min(start + shard_pages - 1, num_pages)) for start in range(1, num_pages + 1, shard_pages)]
+
+
+def partition_shard(file_name, page_range=None, max_retries=partition_max_retries, pdf_hash=None, force_refresh=False):
+    """
+    Partitions a range of pages of a PDF file with Aryn, retrying the shard on its own if the request fails.
 
-    pandas, page_texts = tables_to_pandas(filtered_file), {}
-    tables = []
+    The raw partition result is cached on disk by the content hash of the file and the partition options,
+    so the shard is only sent to Aryn again if the file or the options changed.
 
-    for elt, dataframe in pandas:
-        if elt['type'] == 'table':
-            tables.append(dataframe)
+    Args:
+        file_name (str): The path to the PDF file.
+        page_range (Tuple[int, int], optional): First and last page of the shard, None for the whole file.
+        max_retries (int): Maximum number of retries.
+        pdf_hash (str, optional): Content hash of the file, computed if not given.
+        force_refresh (bool): Partition again even if the result is cached, and replace the cached result.
+
+    Returns:
+        dict: The partitioned shard, with page numbers relative to the whole file.
+    """
+    options = {**PARTITION_OPTIONS, 'selected_pages': [list(page_range)]} if page_range else dict(PARTITION_OPTIONS)
+    cache_key = PartitionCache.key(pdf_hash or file_hash(file_name), options)
+    partitioned_file = None if force_refresh else partition_cache.get(cache_key)
+
+    if partitioned_file is None:
+        # Imported here so that loading documents from JSON does not pay for the Aryn client
+        from aryn_sdk.partition import partition_file
+
+        for attempt in range(max_retries + 1):
+            try:
+                with open(file_name, 'rb') as file:
+                    partitioned_file = partition_file(file, aryn_api_key, **options)
+                break
+            except Exception as e:
+                if attempt == max_retries:
+                    raise
+                delay = min(60.0, 2.0 * 2 ** attempt)
+                print(f"Partitioning pages {page_range} failed ({e}), retrying in {delay:.0f}s (attempt {attempt + 1}/{max_retries})")
+                time.sleep(delay)
+        # The raw result is cached, before the page numbers are adjusted below
+        partition_cache.put(cache_key, partitioned_file)
+
+    # Page numbers that all lie before the shard are relative to it
+    if page_range and page_range[0] > 1:
+        page_numbers = [element['properties']['page_number'] for element in partitioned_file['elements']]
+        if page_numbers and max(page_numbers) < page_range[0]:
+            for element in partitioned_file['elements']:
+                element['properties']['page_number'] += page_range[0] - 1
+    return partitioned_file
+
+
+def iter_partitioned_shards(file_name, shard_pages=partition_shard_pages, workers=partition_workers, force_refresh=False):
+    """
+    Partitions a PDF file in shards of pages concurrently and yields the shards in page order.
+
+    At most twice as many shards as there are workers are in flight or waiting to be consumed, so memory
+    stays bounded regardless of the size of the manual.
 
+    Args:
+        file_name (str): The path to the PDF file.
+        shard_pages (int): Pages per shard.
+        workers (int): Number of shards partitioned concurrently.
+        force_refresh (bool): Ignore cached partition results.
+
+    Yields:
+        dict: The partitioned shards.
+    """
+    pdf_hash = file_hash(file_name)
+    num_pages = count_pdf_pages(file_name)
+    if num_pages <= shard_pages:
+        yield partition_shard(file_name, pdf_hash=pdf_hash, force_refresh=force_refresh)
+        return
+
+    ranges = page_ranges(num_pages, shard_pages)
+    print(f"Partitioning {num_pages} pages in {len(ranges)} shards of {shard_pages} pages.")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
+        for page_range in ranges:
+            pending.append(executor.submit(partition_shard, file_name, page_range, pdf_hash=pdf_hash, force_refresh=force_refresh))
+            if len(pending) >= 2 * max(1, workers):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_elements(partitioned_file):
+    """
+    Filters out non-essential elements of a partitioned shard and yields the text of the remaining ones.
+
+    Tables are converted to CSV. The shard's tables are aligned with its table elements by their position
+    (table_count), which is why every shard is processed on its own.
+
+    Args:
+        partitioned_file (dict): A partitioned shard.
+
+    Yields:
+        Tuple[int, str, str]: Page number, element type and text of every element.
+    """
+    from aryn_sdk.partition import tables_to_pandas
+
+    # Filter out unnecessary elements, without copying the partition result
+    elements = [element for element in partitioned_file['elements'] if element['type'] not in ELEMENT_TYPES_TO_REMOVE]
+
+    # Extract the tables of this shard into pandas DataFrames
+    tables = [dataframe for elt, dataframe in tables_to_pandas({**partitioned_file, 'elements': elements}) if elt['type'] == 'table']
     table_count = 0
-    
-    elements = filtered_file['elements']
-    # Initialize sub-documents list
-    sub_documents = []
-    
-    # Process each element for documents and sub-documents
-    for element in elements:
-        page_num = element['properties']['page_number']
-        element_type = element['type']
 
-        if element_type == 'table':
+    for element in elements:
+        if element['type'] == 'table':
             text = tables[table_count].to_csv(index=False)
             table_count += 1
         else:
             text = element['text_representation']
+        yield element['properties']['page_number'], element['type'], text
 
-        # Append text to page_texts for document aggregation
-        if page_num in page_texts:
-            page_texts[page_num] += "\n" + text
-        else:
-            page_texts[page_num] = text
-        
-        # Create and store sub-document for each element
-        sub_document = Document(
-            page_content=text,
-            metadata={
-                "page_number": page_num,
-                "element_type": element_type
-            }
-        )
-        sub_documents.append(sub_document)
-        
+
+def iter_page_documents(sub_documents):
+    """
+    Aggregates the sub-documents of every page into a page-level document.
+
+    Only the row numbers are grouped in memory; the texts are decoded from the store page by page.
+
+    Args:
+        sub_documents (DocumentStore): The sub-document store.
+
+    Yields:
+        Document: The sub-documents of a page joined by newlines, in order of the first appearance of the page.
+    """
+    page_rows = {}
+    for row, page_number in enumerate(sub_documents.page_numbers.tolist()):
+        page_rows.setdefault(page_number, []).append(row)
+    for page_number, rows in page_rows.items():
+        yield Document(page_content="\n".join(sub_documents.get_text(row) for row in rows), metadata={"page_number": page_number})
+
+
+def process_pdf(file_name: str, shard_pages: int = partition_shard_pages, workers: int = partition_workers,
+                force_refresh: bool = False, store_dir: str = document_store_path) -> Tuple[DocumentStore, DocumentStore]:
+    """
+    Processes a PDF file to extract text and tables, filtering out non-essential elements, and creates Document objects
+    for both full-page content and individual elements.
+
+    Large files are partitioned in shards of shard_pages pages, concurrently; the elements are streamed from the
+    shards into the sub-document store as the shards come in, and a failed shard is retried on its own. No
+    element is kept in memory: the page store and the table store are then built from the memory-mapped
+    sub-document store, and both document stores are returned as opened from disk.
+    Raw partition results are cached on disk (see partition_cache.py), so re-processing an unchanged file
+    only replays filtering, table extraction and document construction. The extracted tables are also kept
+    column by column in the table store (see table_store.py), keyed by page and table index, so that the
+    context can be limited to the table rows relevant to a query.
+    
+    Args:
+    file_name (str): The path to the PDF file to be processed.
+    shard_pages (int): Pages per partition request.
+    workers (int): Number of shards partitioned concurrently.
+    force_refresh (bool): Partition the file again even if cached results exist.
+    store_dir (str): Directory the page, sub-document and table stores are written to.
+
+    Returns:
+    Tuple[DocumentStore, DocumentStore]: The page store, with one document aggregated per page, and the
+        sub-document store, with one document for each individual element, including tables and text elements.
+    """
+    stats_before = partition_cache.stats()
+
+    def stream_sub_documents():
+        for partitioned_file in iter_partitioned_shards(file_name, shard_pages, workers, force_refresh):
+            for page_num, element_type, text in iter_elements(partitioned_file):
+                # Create a sub-document for each element, written to the store right away
+                yield Document(
+                    page_content=text,
+                    metadata={
+                        "page_number": page_num,
+                        "element_type": element_type
+                    }
+                )
+
+    sub_documents_path = os.path.join(store_dir, 'sub_documents')
+    DocumentStore.write(stream_sub_documents(), sub_documents_path)
+    sub_documents = DocumentStore(sub_documents_path)
 
     # Create Document objects for each page
-    documents = [Document(page_content=content, metadata={"page_number": num}) for num, content in page_texts.items()]
-    save_documents_to_json(documents, 'documents.json')
-    save_documents_to_json(sub_documents, 'sub_documents.json')
+    DocumentStore.write(iter_page_documents(sub_documents), os.path.join(store_dir, 'pages'))
+    TableStore.from_sub_documents(sub_documents).save(os.path.join(store_dir, 'tables.json'))
+
+    stats_after = partition_cache.stats()
+    print(f"Partition cache: {stats_after['hits'] - stats_before['hits']} shards replayed from cache, "
+          f"{stats_after['writes'] - stats_before['writes']} partitioned.")
     
-    return documents, sub_documents
+    return DocumentStore(os.path.join(store_dir, 'pages')), sub_documents
+
+
+def build_page_map(documents):
+    """
+    Builds a mapping from page number to page content for a list of page-level documents.
+
+    Args:
+        documents (List[Document]): A list of page-level document objects.
+
+    Returns:
+        dict: A dictionary mapping each page_number to its page_content.
+    """
+    return {doc.metadata['page_number']: doc.page_content for doc in documents}
 
 
 def prepare_context_for_generation(docs, documents):    
@@ -120,14 +281,16 @@ def prepare_context_for_generation(docs, documents):
 
     Args:
         docs (List[Document]): A list of document objects for which context needs to be prepared.
-        documents (List[Document]): A list of document objects containing the original content to be referenced.
+        documents (List[Document] or dict): A list of document objects containing the original content to be referenced,
+            or a page_number -> page_content mapping (see build_page_map and DocumentStore.pages).
 
     Returns:
         str: A string composed of processed document content, joined by double newlines.
     """
     # Create a dictionary to map page_number to page_content from documents for quick lookup.
     # This mapping facilitates efficient retrieval of content by page number.
-    page_to_content = {doc.metadata['page_number']: doc.page_content for doc in documents}
+    # A prebuilt mapping (see build_page_map) can be passed instead to skip this step.
+    page_to_content = build_page_map(documents) if isinstance(documents, list) else documents
 
     # Initialize a list to store the newly processed document contents.
     processed_docs = []
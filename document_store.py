@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import hashlib
+import tracemalloc
+import numpy as np
+from langchain_core.documents import Document
+from config import document_store_path
+
+
+_NO_ELEMENT_TYPE = -1
+
+
+class DocumentStore:
+    """
+    Compact, lazily loaded store of documents with an offset index.
+
+    A store consists of five files sharing a common prefix:
+    '<path>.text.bin' holds the UTF-8 encoded contents back to back and is memory-mapped,
+    '<path>.offsets.npy' holds the start of every document in it (plus the end of the last one),
+    '<path>.page_numbers.npy' and '<path>.element_types.npy' hold the metadata as compact arrays,
+    and '<path>.meta.json' holds the names of the element type codes and the fingerprint of the contents.
+
+    Opening a store only maps the files; a document's text is decoded when it is accessed.
+    Documents are addressed by row like a list (store[i]), and pages by page number through pages().
+
+    Args:
+        path (str): Common prefix of the store files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(f"{path}.offsets.npy", mmap_mode='r')
+        self.page_numbers = np.load(f"{path}.page_numbers.npy", mmap_mode='r')
+        self.element_types = np.load(f"{path}.element_types.npy", mmap_mode='r')
+        with open(f"{path}.meta.json", 'r') as json_file:
+            meta = json.load(json_file)
+        self.element_type_names = meta['element_types']
+        # Stores written before fingerprints were recorded are hashed on first use
+        self._fingerprint = meta.get('fingerprint')
+        # np.memmap cannot map an empty file
+        self.text = np.memmap(f"{path}.text.bin", dtype=np.uint8, mode='r') if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+
+        # Row of each page number, for O(1) page lookups; -1 marks page numbers without a row
+        self._page_rows = np.full(int(self.page_numbers.max()) + 1 if len(self.page_numbers) else 0, -1, dtype=np.int64)
+        # The first row of a page wins, matching the page-level stores with one row per page
+        self._page_rows[self.page_numbers[::-1]] = np.arange(len(self.page_numbers))[::-1]
+
+    @staticmethod
+    def write(documents, path):
+        """
+        Writes Document objects as a store.
+
+        The documents are consumed one by one and their contents streamed to disk, so a generator can be
+        passed to write a store without holding all documents in memory. If consuming them fails, the
+        temporary files are removed and an existing store at path is left untouched.
+
+        Args:
+            documents (Iterable[Document]): The documents to store, with 'page_number' and optionally 'element_type' metadata.
+            path (str): Common prefix of the store files.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        suffixes = ('.text.bin', '.offsets.npy', '.page_numbers.npy', '.element_types.npy', '.meta.json')
+        try:
+            offsets, page_numbers, element_types, first_seen_codes = [0], [], [], {}
+            digest = hashlib.sha256()
+            with open(f"{path}.text.bin.tmp", 'wb') as text_file:
+                for doc in documents:
+                    encoded = doc.page_content.encode('utf-8')
+                    text_file.write(encoded)
+                    offsets.append(offsets[-1] + len(encoded))
+                    page_numbers.append(doc.metadata['page_number'])
+                    element_type = doc.metadata.get('element_type')
+                    _update_fingerprint(digest, encoded, doc.metadata['page_number'], element_type)
+                    element_types.append(_NO_ELEMENT_TYPE if element_type is None else first_seen_codes.setdefault(element_type, len(first_seen_codes)))
+
+            # Codes follow the sorted element type names, independent of the order the documents came in
+            element_type_names = sorted(first_seen_codes)
+            remap = np.array([element_type_names.index(name) for name in first_seen_codes] + [_NO_ELEMENT_TYPE], dtype=np.int8)
+            element_types = remap[np.array(element_types, dtype=np.int64)] if element_types else np.zeros(0, dtype=np.int8)
+
+            # Every file is written next to its target and then swapped in, so a running process that has the
+            # previous store memory-mapped keeps reading the old contents until it reloads
+            files = {
+                '.offsets.npy': lambda file: np.save(file, np.array(offsets, dtype=np.int64)),
+                '.page_numbers.npy': lambda file: np.save(file, np.array(page_numbers, dtype=np.int32)),
+                '.element_types.npy': lambda file: np.save(file, element_types),
+                '.meta.json': lambda file: file.write(json.dumps({'element_types': element_type_names,
+                                                                       'fingerprint': digest.hexdigest()}).encode('utf-8')),
+            }
+            for suffix, write_file in files.items():
+                with open(f"{path}{suffix}.tmp", 'wb') as file:
+                    write_file(file)
+            for suffix in suffixes:
+                os.replace(f"{path}{suffix}.tmp", f"{path}{suffix}")
+        except Exception:
+            # A failing document source, e.g. a partitioning error, must not leave half-written files behind
+            for suffix in suffixes:
+                if os.path.exists(f"{path}{suffix}.tmp"):
+                    os.remove(f"{path}{suffix}.tmp")
+            raise
+
+    @classmethod
+    def from_json(cls, json_path, path):
+        """
+        Migrates a documents.json / sub_documents.json file written by data_prep.save_documents_to_json.
+
+        Args:
+            json_path (str): Path to the JSON file.
+            path (str): Common prefix of the store files to write.
+
+        Returns:
+            DocumentStore: The opened store.
+        """
+        # Imported here to keep data_prep, which imports this module, out of the import cycle
+        from data_prep import load_documents_from_json
+        cls.write(load_documents_from_json(json_path), path)
+        print(f"Migrated {json_path} to the document store at {path}")
+        return cls(path)
+
+    def __len__(self):
+        return len(self.page_numbers)
+
+    @property
+    def fingerprint(self):
+        """
+        Hash of the contents and metadata of all documents, equal to document_fingerprint() of the written documents.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = _hash_documents(self)
+        return self._fingerprint
+
+    def get_text(self, row):
+        """
+        Decodes the content of a single document.
+
+        Args:
+            row (int): Row of the document.
+
+        Returns:
+            str: The document content.
+        """
+        return self.text[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, row):
+        metadata = {'page_number': int(self.page_numbers[row])}
+        if self.element_types[row] != _NO_ELEMENT_TYPE:
+            metadata['element_type'] = self.element_type_names[self.element_types[row]]
+        return Document(page_content=self.get_text(row), metadata=metadata)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def get_page(self, page_number):
+        """
+        Returns the content of a page in O(1) without decoding any other document.
+
+        Args:
+            page_number (int): The page number.
+
+        Returns:
+            str or None: The page content, or None if the page is not in the store.
+        """
+        if not 0 <= page_number < len(self._page_rows) or self._page_rows[page_number] < 0:
+            return None
+        return self.get_text(self._page_rows[page_number])
+
+    def pages(self):
+        """
+        Returns a read-only page_number -> page_content mapping backed by the store.
+
+        It can be passed wherever a page map from data_prep.build_page_map is expected.
+        """
+        return PageMap(self)
+
+
+def _update_fingerprint(digest, encoded, page_number, element_type):
+    # The length prefix keeps the boundaries between documents part of the hash
+    digest.update(json.dumps([len(encoded), int(page_number), element_type]).encode('utf-8'))
+    digest.update(encoded)
+
+
+def _hash_documents(documents):
+    digest = hashlib.sha256()
+    for doc in documents:
+        _update_fingerprint(digest, doc.page_content.encode('utf-8'), doc.metadata['page_number'], doc.metadata.get('element_type'))
+    return digest.hexdigest()
+
+
+def document_fingerprint(documents):
+    """
+    Returns a hash of the contents, page numbers and element types of documents, in order.
+
+    Indexes built over the sub-documents store it and are rebuilt when it changes, which also catches edits
+    that keep the number of documents. A DocumentStore records it when it is written, so comparing costs
+    nothing; a list of documents is hashed on every call.
+
+    Args:
+        documents (List[Document] or DocumentStore): The documents.
+
+    Returns:
+        str: Hex digest, identical for a list of documents and the store written from it.
+    """
+    if isinstance(documents, DocumentStore):
+        return documents.fingerprint
+    return _hash_documents(documents)
+
+
+class PageMap:
+    """
+    Lazy page_number -> page_content mapping over a DocumentStore.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, page_number):
+        return self.store.get_page(page_number) is not None
+
+    def __getitem__(self, page_number):
+        content = self.store.get_page(page_number)
+        if content is None:
+            raise KeyError(page_number)
+        return content
+
+    def get(self, page_number, default=None):
+        content = self.store.get_page(page_number)
+        return default if content is None else content
+
+
+def open_document_store(name, json_path=None, store_dir=document_store_path):
+    """
+    Opens a document store, migrating it from its legacy JSON file on first use.
+
+    Args:
+        name (str): Name of the store, 'pages' or 'sub_documents'.
+        json_path (str, optional): Legacy JSON file to migrate from if the store does not exist yet.
+        store_dir (str): Directory holding the stores.
+
+    Returns:
+        DocumentStore: The opened store.
+    """
+    path = os.path.join(store_dir, name)
+    if not os.path.exists(f"{path}.meta.json") and json_path and os.path.exists(json_path):
+        return DocumentStore.from_json(json_path, path)
+    return DocumentStore(path)
+
+
+def measure_load(json_path, name, lookups=50):
+    """
+    Compares load time and memory of the JSON file against the document store.
+
+    The measurement covers loading plus a number of lookups: pages by page number for the page store
+    (as in context preparation) and documents by row for the sub-document store (as in BM25 retrieval).
+
+    Args:
+        json_path (str): Path to the JSON file.
+        name (str): Name of the corresponding store, 'pages' or 'sub_documents'.
+        lookups (int): Number of lookups included in the measurement.
+    """
+    from data_prep import load_documents_from_json, build_page_map
+    by_page = name == 'pages'
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    documents = load_documents_from_json(json_path)
+    if by_page:
+        page_map = build_page_map(documents)
+        for page_number in list(page_map)[:lookups]:
+            page_map[page_number]
+    else:
+        for row in range(min(lookups, len(documents))):
+            documents[row]
+    json_ms = (time.perf_counter() - start_time) * 1000
+    json_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del documents
+
+    # Migrate outside of the measurement
+    open_document_store(name, json_path)
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    store = open_document_store(name, json_path)
+    if by_page:
+        page_map = store.pages()
+        for page_number in np.unique(store.page_numbers)[:lookups]:
+            page_map[int(page_number)]
+    else:
+        for row in range(min(lookups, len(store))):
+            store[row]
+    store_ms = (time.perf_counter() - start_time) * 1000
+    store_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    store_bytes = sum(os.path.getsize(f"{store.path}{suffix}")
+                      for suffix in ('.text.bin', '.offsets.npy', '.page_numbers.npy', '.element_types.npy', '.meta.json'))
+    print(f"{json_path}: {os.path.getsize(json_path) / 1024:.0f} KB, load + {lookups} lookups "
+          f"{json_ms:.1f} ms, peak memory {json_peak / 1024:.0f} KB")
+    print(f"{store.path}: {store_bytes / 1024:.0f} KB, load + {lookups} lookups "
+          f"{store_ms:.1f} ms, peak memory {store_peak / 1024:.0f} KB")
+
+
+if __name__ == '__main__':
+    measure_load('documents.json', 'pages')
+    measure_load('sub_documents.json', 'sub_documents')
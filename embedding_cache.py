@@ -0,0 +1,155 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Drop-in embeddings wrapper that caches vectors on local disk and in an in-memory LRU.
+
+    Vectors are stored in a SQLite file keyed by the embedding backend and model name plus a hash of the text,
+    so re-indexing, evaluation reruns and repeated user questions never pay for the same embedding twice.
+    Cache misses are de-duplicated and sent to the wrapped client in batches. While the provider callable
+    returns None, e.g. when benchmark.py has installed local stand-ins, every call goes straight to the
+    wrapped client and the cache is neither read nor written.
+
+    Args:
+        embeddings (Embeddings): The wrapped embeddings client, e.g. JinaEmbeddings.
+        model_name (str): Name of the embedding model, part of every cache key.
+        provider (Callable, optional): Returns the name of the backend behind the wrapped client, part of every
+            cache key, or None to bypass the cache. Without it the backend is left out of the keys.
+        cache_path (str): Path to the SQLite file holding the cached vectors.
+        memory_size (int): Number of vectors kept in the in-memory LRU.
+        batch_size (int): Maximum number of texts sent to the wrapped client per request.
+    """
+
+    def __init__(self, embeddings, model_name, provider=None, cache_path='embedding_cache.sqlite', memory_size=2048,
+                 batch_size=64):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.provider = provider
+        self.cache_path = cache_path
+        self.memory_size = memory_size
+        self.batch_size = batch_size
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._connection = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _get_connection(self):
+        # Opened on first use, so importing config does not touch the disk
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        return self._connection
+
+    def _key(self, text, kind, provider):
+        # Queries and documents are cached separately, in case a backend embeds them differently
+        prefix = f"{provider}\0" if provider else ""
+        return hashlib.sha256(f"{prefix}{self.model_name}\0{kind}\0{text}".encode('utf-8')).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        """
+        Looks keys up in memory first and then on disk.
+
+        Returns:
+            dict: Mapping from key to vector for every key found.
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            self.memory_hits += len(found)
+
+            on_disk = [key for key in dict.fromkeys(keys) if key not in found]
+            connection = self._get_connection()
+            # Stay below SQLite's limit on the number of bound parameters
+            for start in range(0, len(on_disk), 500):
+                chunk = on_disk[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                    found[key] = vector
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+        return found
+
+    def _store(self, keyed_vectors):
+        with self._lock:
+            connection = self._get_connection()
+            connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                   [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in keyed_vectors])
+            connection.commit()
+            for key, vector in keyed_vectors:
+                self._remember(key, vector)
+
+    def _embed(self, texts, kind, embed_batch):
+        provider = self.provider() if self.provider is not None else ''
+        if provider is None:
+            # Overridden client, its vectors must not end up in the cache of the configured backend
+            vectors = []
+            for start in range(0, len(texts), self.batch_size):
+                vectors.extend(list(vector) for vector in embed_batch(texts[start:start + self.batch_size]))
+            return vectors
+
+        keys = [self._key(text, kind, provider) for text in texts]
+        found = self._lookup(keys)
+
+        # Each distinct missing text is embedded once, in batches
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        with self._lock:
+            self.misses += len(missing)
+        missing_items = list(missing.items())
+        for start in range(0, len(missing_items), self.batch_size):
+            batch = missing_items[start:start + self.batch_size]
+            vectors = embed_batch([text for _, text in batch])
+            keyed_vectors = [(key, list(vector)) for (key, _), vector in zip(batch, vectors)]
+            self._store(keyed_vectors)
+            found.update(keyed_vectors)
+
+        return [found[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embeds documents, reusing cached vectors and batching the misses."""
+        return self._embed(texts, 'document', self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embeds a query, reusing the cached vector of a previously seen query."""
+        return self._embed([text], 'query', lambda batch: [self.embeddings.embed_query(batch[0])])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds several queries with a single batched request for the cache misses.
+
+        The query texts are sent through embed_documents of the wrapped client, which uses the same
+        endpoint as embed_query for the Jina client.
+        """
+        return self._embed(texts, 'query', self.embeddings.embed_documents)
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Memory hits, disk hits, misses and the overall hit rate.
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0}
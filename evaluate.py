@@ -1,124 +1,399 @@
 import pandas as pd
-from langchain_chroma import Chroma
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
-from data_prep import prepare_context_for_generation
-from config import llm, text_embeddings
+from query_engine import QueryEngine
+from config import text_embeddings
+from llm_utils import invoke_with_backoff
+from tracing import tracer, span, record_usage
 from prompts import RESPONSE_GENERATION_PROMPT, EVALUATION_PROMPT
 import os
-from data_prep import load_documents_from_json
+import re
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 from langchain_core.documents import Document
-import streamlit as st
-from config import vector_store_path, k_value
+from judge_cache import JudgeCache
+from config import vector_store_path, vector_backend, flat_index_path, bm25_index_path, k_value
+from config import retriever_weights, rrf_k, retrieval_eval_cutoffs, judge_cache_path, llm_name
 
-        
-def evaluate_queries(csv_file_path, vector_store_path, text_embeddings, RESPONSE_GENERATION_PROMPT, EVALUATION_PROMPT, output_file_path):
+# Page references of the reference answers: 'Seite 85', 'Seite 9-12', 'Seite 15-17, 19-21, 24', 'Seitenzahl 214'
+_PAGE_REFERENCE_RE = re.compile(r"\bSeite(?:n|nzahl)?\s+(\d+(?:\s*[-–]\s*\d+)?(?:\s*(?:,|und|sowie)\s*\d+(?:\s*[-–]\s*\d+)?)*)(?![\w-])")
+_PAGE_RANGE_RE = re.compile(r"(\d+)(?:\s*[-–]\s*(\d+))?")
+# Longer spans are rather a misread than a page range, only their first page is kept
+_MAX_PAGE_RANGE = 30
+
+
+
+def load_checkpoint(checkpoint_path, data):
+    """
+    Loads the rows finished by a previous, interrupted run.
+
+    Only records whose query still matches the row at the same index are reused, so a changed
+    question file never mixes up results.
+
+    Args:
+        checkpoint_path (str): Path to the JSON lines checkpoint file.
+        data (pd.DataFrame): The evaluation questions.
+
+    Returns:
+        dict: Mapping from row index to the checkpointed record.
+    """
+    finished = {}
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return finished
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut off by the interruption
+                continue
+            index = record['index']
+            if index in data.index and data.at[index, 'Frage'] == record['Frage']:
+                finished[index] = record
+    return finished
+
+
+def parse_page_references(text):
+    """
+    Extracts the pages cited by a reference answer, such as 'Seite 85' or 'Seite 15-17, 19-21, 24'.
+
+    Section labels such as 'Seite C12' are not page numbers of the manual and are ignored.
+
+    Args:
+        text (str): The reference answer.
+
+    Returns:
+        List[int]: The cited page numbers in order of first citation, ranges expanded.
+    """
+    pages = []
+    for reference in _PAGE_REFERENCE_RE.finditer(text if isinstance(text, str) else ''):
+        for page_range in _PAGE_RANGE_RE.finditer(reference.group(1)):
+            first = int(page_range.group(1))
+            last = int(page_range.group(2)) if page_range.group(2) else first
+            if not first <= last <= first + _MAX_PAGE_RANGE:
+                last = first
+            pages.extend(range(first, last + 1))
+    return list(dict.fromkeys(pages))
+
+
+def retrieval_metrics(retrieved_pages, relevant_pages, cutoffs=retrieval_eval_cutoffs):
+    """
+    Computes recall@n and the reciprocal rank of the retrieved pages of one query.
+
+    Args:
+        retrieved_pages (List[int]): Distinct retrieved pages, best first.
+        relevant_pages (List[int]): The pages cited by the reference answer.
+        cutoffs (List[int]): Page cutoffs n of recall@n.
+
+    Returns:
+        dict: 'recall@n' for every cutoff, the share of relevant pages among the first n retrieved pages,
+        and 'reciprocal_rank', 1 / rank of the first relevant page or 0 if none was retrieved.
+    """
+    relevant = set(relevant_pages)
+    metrics = {f"recall@{n}": len(relevant.intersection(retrieved_pages[:n])) / len(relevant) for n in cutoffs}
+    ranks = [rank for rank, page in enumerate(retrieved_pages, start=1) if page in relevant]
+    metrics['reciprocal_rank'] = 1 / ranks[0] if ranks else 0.0
+    return metrics
+
+
+def evaluate_retrieval(csv_file_path, query_engine=None, k_values=(k_value,), weight_grid=(retriever_weights,), rrf_k_values=(rrf_k,),
+                       cutoffs=retrieval_eval_cutoffs, output_file_path='retrieval_sweep.csv'):
+    """
+    Evaluates the retrieval alone against the pages cited by the reference answers, without any LLM call.
+
+    Every combination of the given k values, fusion weights and rank offsets is evaluated on the questions
+    whose reference answer cites pages. Query embeddings are served from the embedding cache after the first
+    run, so a sweep over a grid takes seconds.
+
+    Args:
+        csv_file_path (str): Path to the CSV file with the queries ('Frage') and reference answers ('Antwort').
+        query_engine (QueryEngine, optional): The engine to retrieve with, defaults to one over the configured stores.
+        k_values (List[int]): Numbers of chunks retrieved from the vector store.
+        weight_grid (List[List[float]]): Weights of the BM25 and vector results in the rank fusion.
+        rrf_k_values (List[int]): Rank offsets of the reciprocal rank fusion.
+        cutoffs (List[int]): Page cutoffs n of recall@n.
+        output_file_path (str, optional): Path to save the CSV file with one row per setting.
+
+    Returns:
+        pd.DataFrame: One row per setting with the mean recall@n over the retrieved pages, the recall of the
+        pages packed into the context, the mean reciprocal rank (MRR) and the retrieval time.
+    """
+    data = pd.read_csv(csv_file_path)
+    data.columns = data.columns.str.strip()
+    references = [(row['Frage'], parse_page_references(row['Antwort'])) for _, row in data.iterrows()]
+    references = [(query, pages) for query, pages in references if pages]
+    queries = [query for query, _ in references]
+    print(f"{len(references)}/{len(data)} reference answers cite pages.")
+
+    query_engine = query_engine or QueryEngine()
+    settings = []
+    for k in k_values:
+        for weights in weight_grid:
+            for rrf_k_value in rrf_k_values:
+                query_engine.configure_fusion(weights=weights, rrf_k=rrf_k_value)
+                start_time = time.perf_counter()
+                retrieved = query_engine.retrieve_many(queries, k=k)
+                elapsed = time.perf_counter() - start_time
+
+                rows = []
+                for (query, pages), docs in zip(references, retrieved):
+                    retrieved_pages = list(dict.fromkeys(doc.metadata['page_number'] for doc in docs))
+                    metrics = retrieval_metrics(retrieved_pages, pages, cutoffs)
+                    packed = query_engine.build_context(docs, query, query_engine.response_prompt)
+                    metrics['context_recall'] = len(set(pages).intersection(packed.pages)) / len(pages)
+                    rows.append(metrics)
+
+                summary = pd.DataFrame(rows).mean()
+                setting = {'k': k, 'weights': ','.join(str(weight) for weight in weights), 'rrf_k': rrf_k_value}
+                setting.update({f"recall@{n}": summary[f"recall@{n}"] for n in cutoffs})
+                setting.update({'context_recall': summary['context_recall'], 'mrr': summary['reciprocal_rank'], 'retrieval_s': elapsed})
+                settings.append(setting)
+
+    results = pd.DataFrame(settings).round(4)
+    print(results.to_string(index=False))
+    if output_file_path:
+        results.to_csv(output_file_path, index=False)
+        print(f"Retrieval evaluation saved to {output_file_path}.")
+    return results
+
+
+def evaluate_queries(csv_file_path, vector_store_path, text_embeddings, RESPONSE_GENERATION_PROMPT, EVALUATION_PROMPT, output_file_path,
+                     workers=1, checkpoint_path='evaluation_checkpoint.jsonl', judge_cache_path='judge_cache.sqlite'):
     """
     Evaluates queries from a CSV file using a RAG pipeline and LLM for response generation and scoring.
 
     Parameters:
         csv_file_path (str): Path to the input CSV file containing the queries and reference answers.
-        vector_store_path (str): Path to the vector store directory for Chroma.
+        vector_store_path (str): Path to the vector store directory of the backend selected in config.vector_backend.
         text_embeddings (function): Embedding function for vector database initialization.
         RESPONSE_GENERATION_PROMPT (str): Prompt template for generating responses using the LLM.
         EVALUATION_PROMPT (str): Prompt template for evaluating the generated responses.
         output_file_path (str): Path to save the CSV file containing evaluation results.
+        workers (int): Number of queries processed concurrently.
+        checkpoint_path (str): JSON lines file to which every finished row is appended. An interrupted run
+            resumes from it; it is removed once all rows have been evaluated successfully.
+        judge_cache_path (str): SQLite file caching the judge scores by query, reference and generated answer, so
+            unchanged answers are not judged again. None judges every answer.
 
     Returns:
         None
 
-    This function processes each query in the input CSV file, generates responses using the RAG pipeline, evaluates the responses, 
-    and saves the results with generated answers and evaluation scores in the output CSV file.
+    This function processes the queries in the input CSV file on a pool of worker threads, generates responses using the RAG pipeline,
+    evaluates the responses, and saves the results with generated answers and evaluation scores in the output CSV file.
+    The rows of the output keep the order of the input file regardless of the order in which they finish.
     """
-    import pandas as pd
-
     # Load the CSV file
     data = pd.read_csv(csv_file_path)
     data.columns = data.columns.str.strip()
 
-    # Initialize your LLM pipeline and retrievers
-    vectordb = Chroma(persist_directory=vector_store_path, embedding_function=text_embeddings)
-    
-    sub_documents = load_documents_from_json('sub_documents.json')
-    docs_retriever = vectordb.as_retriever(search_kwargs={"k": 10}) #search_type="mmr",
-    bm25_retriever = BM25Retriever.from_documents(sub_documents)
-    ensemble_retriever = EnsembleRetriever(retrievers=[docs_retriever, bm25_retriever], weights=[0.5, 0.5])
-    documents = load_documents_from_json('documents.json')
+    # Initialize the same retrieval stack as the Streamlit app, so both are evaluated identically
+    query_engine = QueryEngine(vector_backend=vector_backend, bm25_index_path=bm25_index_path, embeddings=text_embeddings,
+                               vector_store_path=vector_store_path)
 
     # Add columns for generated answer and evaluation score
     data['Generated Answer'] = ""
     data['Eva_Score'] = 0
 
-    # Process each query
-    for index, row in data.iterrows():
+    results = load_checkpoint(checkpoint_path, data)
+    if results:
+        print(f"Resuming from {checkpoint_path}: {len(results)}/{len(data)} queries already evaluated.")
+    checkpoint_lock = threading.Lock()
+    retrieved = {}
+    judge_cache = JudgeCache(judge_cache_path, llm_name, EVALUATION_PROMPT) if judge_cache_path else None
+
+    def process_query(index, query, reference_answer):
+        """
+        Generates and scores the answer for a single row, traced when tracing is enabled.
+        """
+        with tracer.trace('evaluate', index=index) as trace:
+            record = evaluate_row(index, query, reference_answer)
+        if tracer.enabled:
+            record['trace'] = trace.to_dict()
+        # Only fully evaluated rows are checkpointed, so a rerun evaluates the others again
+        if checkpoint_path and 'Frage' in record:
+            with checkpoint_lock, open(checkpoint_path, 'a') as checkpoint_file:
+                checkpoint_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return record
+
+    def evaluate_row(index, query, reference_answer):
         try:
-            print(f"Processing query {index + 1}/{len(data)}: {row['Frage']}")
-            query = row['Frage']
-            reference_answer = row['Antwort']
-            
-            # Generate answer
-            k_value = k_value
-            generated_answer = None
-            while k_value > 0:
-                try:
-                    docs_retriever.search_kwargs["k"] = k_value
-                    retrieved_docs = ensemble_retriever.invoke(query)
-                    context = prepare_context_for_generation(retrieved_docs, documents)
-                    filled_prompt = RESPONSE_GENERATION_PROMPT.format(context=context, question=query)
-                    response = llm.invoke(filled_prompt)
-                    generated_answer = response.content.strip()
-                    break
-                except Exception as e:
-                    if k_value > 2:
-                        k_value -= 2
-                    else:
-                        generated_answer = "Error generating answer."
-                        raise e
-            
-            # Store the generated answer
-            data.at[index, 'Generated Answer'] = generated_answer
-            
-            # Evaluate the generated answer
-            eval_prompt = EVALUATION_PROMPT.format(query=query, reference_answer=reference_answer, generated_answer=generated_answer)
-            try:
-                eval_response = llm.invoke(eval_prompt)
-                eval_score = int(eval_response.content.strip())
-            except Exception as e:
-                print(f"Error during evaluation: {e}")
-                eval_score = 0  # Default to 0 if evaluation fails
-            
-            # Store the evaluation score
-            data.at[index, 'Eva_Score'] = eval_score
-        
+            # Generate answer with a single LLM call on a context packed into the token budget
+            retrieved_docs = retrieved.get(index)
+            if retrieved_docs is None:
+                retrieved_docs = query_engine.retrieve(query, k=k_value)
+            packed = query_engine.build_context(retrieved_docs, query, RESPONSE_GENERATION_PROMPT)
+            filled_prompt = RESPONSE_GENERATION_PROMPT.format(context=packed.context, question=query)
+            with span('llm'):
+                response = invoke_with_backoff(filled_prompt)
+            record_usage(response)
+            generated_answer = response.content.strip()
         except Exception as e:
             print(f"Failed to process query at index {index}: {e}")
-            data.at[index, 'Generated Answer'] = "Error processing query."
-            data.at[index, 'Eva_Score'] = 0
+            return {'index': index, 'Generated Answer': "Error processing query.", 'Eva_Score': 0}
+
+        # Evaluate the generated answer, unless the same answer was already judged
+        try:
+            eval_score = judge_cache.get(query, reference_answer, generated_answer) if judge_cache else None
+            if eval_score is None:
+                eval_prompt = EVALUATION_PROMPT.format(query=query, reference_answer=reference_answer, generated_answer=generated_answer)
+                with span('judge'):
+                    eval_response = invoke_with_backoff(eval_prompt)
+                eval_score = int(eval_response.content.strip())
+                if judge_cache:
+                    judge_cache.put(query, reference_answer, generated_answer, eval_score)
+        except Exception as e:
+            print(f"Error during evaluation of query at index {index}: {e}")
+            # Default to 0 if evaluation fails
+            return {'index': index, 'Generated Answer': generated_answer, 'Eva_Score': 0}
+
+        return {'index': index, 'Frage': query, 'Generated Answer': generated_answer, 'Eva_Score': eval_score,
+                'context_tokens': packed.tokens, 'tokens_saved': packed.tokens_saved}
+
+    # Process the remaining queries concurrently
+    pending = [(index, row['Frage'], row['Antwort']) for index, row in data.iterrows() if index not in results]
+    # Retrieve for all remaining queries at once: one batched embedding request and one scoring pass per index
+    # The rows then no longer trace their own retrieval stages, the batch is traced as a whole instead
+    start_time = time.perf_counter()
+    batch_trace = None
+    try:
+        with tracer.trace('evaluate_retrieval', queries=len(pending)) as batch_trace:
+            retrieved.update(zip([index for index, _, _ in pending], query_engine.retrieve_many([query for _, query, _ in pending], k=k_value)))
+        print(f"Retrieved context for {len(pending)} queries in {time.perf_counter() - start_time:.2f}s.")
+    except Exception as e:
+        # Every row then retrieves on its own and reports its own error
+        print(f"Batched retrieval failed, retrieving per query: {e}")
+    failed = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(process_query, *task) for task in pending]
+        for done, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            results[record['index']] = record
+            failed += 'Frage' not in record
+            elapsed = time.perf_counter() - start_time
+            print(f"[{done}/{len(pending)}] Finished query {record['index'] + 1}/{len(data)} "
+                  f"({done / elapsed:.2f} queries/s, {elapsed:.1f}s elapsed)")
+
+    # Store the results in the original row order
+    for index, record in results.items():
+        data.at[index, 'Generated Answer'] = record['Generated Answer']
+        data.at[index, 'Eva_Score'] = record['Eva_Score']
+
+    if tracer.enabled:
+        data = add_trace_columns(data, results, batch_trace.to_dict() if batch_trace and pending else None)
 
     # Save the results to a new CSV file
     data.to_csv(output_file_path, index=False)
 
+    if checkpoint_path and not failed and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
     print(f"Evaluation completed. Results saved to {output_file_path}.")
+    if judge_cache:
+        stats = judge_cache.stats()
+        print(f"Judge cache: {stats['hits']} answers already judged, {stats['misses']} judged now.")
+    if failed:
+        print(f"{failed} queries failed; rerun to retry them, finished rows are kept in {checkpoint_path}.")
+
+
+def add_trace_columns(data, results, batch_trace=None):
+    """
+    Adds the per-stage latencies and token counts of the traced rows to the results, followed by p50 and
+    p95 summary rows, and prints the summary.
+
+    Rows retrieved in the batch only trace context building, generation and judging. The retrieval stages
+    of the batch are added as a '[batch retrieval]' row with the total time of every stage, followed by a
+    '[batch per query]' row with these times divided by the number of queries.
+
+    Args:
+        data (pd.DataFrame): The evaluation results.
+        results (dict): Mapping from row index to the record of the row, with its trace under 'trace'.
+        batch_trace (dict, optional): The trace of the batched retrieval, as returned by Trace.to_dict().
+
+    Returns:
+        pd.DataFrame: The results with the trace columns and summary rows.
+    """
+    trace_columns = {}
+    for index, record in results.items():
+        trace = record.get('trace')
+        if not trace:
+            continue
+        values = {f"{stage}_ms": ms for stage, ms in trace['stages_ms'].items()}
+        for field in ('prompt_tokens', 'completion_tokens', 'context_tokens', 'context_pages', 'tokens_saved', 'retries'):
+            if field in trace:
+                values[field] = trace[field]
+        trace_columns[index] = values
+    batch_rows = []
+    if batch_trace:
+        batch_ms = {f"{stage}_ms": ms for stage, ms in batch_trace['stages_ms'].items()}
+        queries = max(1, batch_trace.get('queries', 1))
+        batch_rows = [{'Frage': '[batch retrieval]', **batch_ms},
+                      {'Frage': '[batch per query]', **{column: round(ms / queries, 3) for column, ms in batch_ms.items()}}]
+    if not trace_columns and not batch_rows:
+        return data
+
+    traced = pd.DataFrame.from_dict(trace_columns, orient='index')
+    batch = pd.DataFrame(batch_rows)
+    # Stage columns first, in the order of the pipeline
+    stage_order = ['query_embedding_ms', 'vector_search_ms', 'bm25_ms', 'fusion_ms', 'retrieval_ms', 'context_build_ms', 'llm_ms', 'judge_ms', 'total_ms']
+    available = list(dict.fromkeys([*traced.columns, *(column for column in batch.columns if column != 'Frage')]))
+    columns = [column for column in stage_order if column in available] + [column for column in available if column not in stage_order]
+    data = data.join(traced.reindex(columns=columns))
+
+    summary = pd.DataFrame([traced.reindex(columns=columns).quantile(0.5), traced.reindex(columns=columns).quantile(0.95)]).round(3)
+    summary.insert(0, 'Frage', ['[p50]', '[p95]'])
+    summary = pd.concat([summary, batch], ignore_index=True)
+    print("Per-stage latency over the traced rows and of the batched retrieval:")
+    print(summary.set_index('Frage')[[column for column in columns if column.endswith('_ms')]].T.to_string())
+    return pd.concat([data, summary], ignore_index=True)
+
+
+def parse_weights(text):
+    """
+    Parses fusion weights given on the command line as 'bm25,vector', e.g. '0.3,0.7'.
+    """
+    weights = [float(weight) for weight in text.split(',')]
+    if len(weights) != 2:
+        raise argparse.ArgumentTypeError(f"expected two comma-separated weights, got '{text}'")
+    return weights
 
 
 def main():
     """
     Main function to execute the query evaluation process.
     """
+    parser = argparse.ArgumentParser(description="Evaluate the RAG pipeline on questions_answers.csv.")
+    parser.add_argument('--workers', type=int, default=4, help="Number of queries evaluated concurrently.")
+    parser.add_argument('--checkpoint', default='evaluation_checkpoint.jsonl', help="Checkpoint file used to resume interrupted runs.")
+    parser.add_argument('--judge-cache', default=judge_cache_path, help="Cache of the judge scores, an empty string judges every answer again.")
+    parser.add_argument('--retrieval-only', action='store_true',
+                        help="Only score the retrieved pages against the pages cited by the reference answers, without LLM calls.")
+    parser.add_argument('--k', type=int, nargs='+', default=[k_value], help="Numbers of chunks retrieved, swept with --retrieval-only.")
+    parser.add_argument('--weights', type=parse_weights, nargs='+', default=[retriever_weights],
+                        help="BM25 and vector fusion weights such as 0.3,0.7, swept with --retrieval-only.")
+    parser.add_argument('--rrf-k', type=int, nargs='+', default=[rrf_k], help="Rank offsets of the fusion, swept with --retrieval-only.")
+    parser.add_argument('--sweep-output', default='retrieval_sweep.csv', help="CSV file of the --retrieval-only results.")
+    args = parser.parse_args()
+
+    if args.retrieval_only:
+        query_engine = QueryEngine(vector_backend=vector_backend, bm25_index_path=bm25_index_path, embeddings=text_embeddings,
+                                   vector_store_path=flat_index_path if vector_backend == 'flat' else vector_store_path)
+        evaluate_retrieval('questions_answers.csv', query_engine, k_values=args.k, weight_grid=args.weights,
+                           rrf_k_values=args.rrf_k, output_file_path=args.sweep_output)
+        return
 
     evaluate_queries(
         csv_file_path='questions_answers.csv',
-        vector_store_path=vector_store_path,
+        vector_store_path=flat_index_path if vector_backend == 'flat' else vector_store_path,
         text_embeddings=text_embeddings,
         RESPONSE_GENERATION_PROMPT=RESPONSE_GENERATION_PROMPT,
         EVALUATION_PROMPT=EVALUATION_PROMPT,
-        output_file_path='evaluation_results.csv'
+        output_file_path='evaluation_results.csv',
+        workers=args.workers,
+        checkpoint_path=args.checkpoint,
+        judge_cache_path=args.judge_cache or None
     )
 
 if __name__ == "__main__":
     main()
-
-
-
-
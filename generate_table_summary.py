@@ -1,52 +1,119 @@
-from config import llm
 from prompts import TABLE_SUMMARY_PROMPT
+from llm_utils import invoke_with_backoff, RateLimiter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import threading
 import json
+import os
 
 
-def generate_and_save_table_summaries(tables, filename = 'table_summary'):
+def table_hash(table):
+    """
+    Computes the cache key of a table from its CSV content.
+
+    Args:
+        table (str): The table in CSV format.
+
+    Returns:
+        str: The SHA-256 hex digest of the table.
+    """
+    return hashlib.sha256(table.encode('utf-8')).hexdigest()
+
+
+def save_table_summaries(summaries, filename):
+    """
+    Writes the summary cache atomically, so an interrupted write never corrupts the existing file.
+
+    Args:
+        summaries (dict): Mapping from table hash to summary.
+        filename (str): The name of the JSON file to write.
+    """
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'w') as file:
+        json.dump(summaries, file)
+    os.replace(temp_filename, filename)
+
+
+def generate_and_save_table_summaries(tables, filename = 'table_summary', max_workers=4, requests_per_minute=30, flush_every=5):
     """
     Generates summaries for a list of tables using a language model and saves the summaries to a JSON file.
 
+    Summaries are cached by a hash of the table CSV, so only new or changed tables call the LLM. The missing
+    summaries are generated concurrently within the rate limit and the cache is flushed to disk every
+    flush_every summaries, so a partial run is never wasted.
+
     Args:
         tables (list): A list of table data, each entry formatted as needed by the TABLE_SUMMARY_PROMPT.
         filename (str, optional): The name of the file to save the summaries. Defaults to 'table_summary'.
+        max_workers (int, optional): Number of concurrent LLM requests. Defaults to 4.
+        requests_per_minute (float, optional): Maximum number of LLM requests started per minute. Defaults to 30.
+        flush_every (int, optional): Number of new summaries after which the cache is written to disk. Defaults to 5.
 
     Returns:
-        list: A list of generated text summaries for each table.
+        list: A list of text summaries, one for each table in the order of tables.
     """
-    
-    # Notify the start of summary generation process.
-    print('started generating summaries')
-    text_summaries = []
-    for table in tables:
-        # Format the prompt with the current table's data.
-        filled_prompt = TABLE_SUMMARY_PROMPT.format(table=table)
-        # Invoke the language model with the formatted prompt.
-        response = llm.invoke(filled_prompt)
-        # Append the content of the response to the text_summaries list.
-        text_summaries.append(response.content)
-    
-    # Save summaries to JSON
-    with open(filename, 'w') as file:
-        json.dump(text_summaries, file)
-        
-    # Notify the end of the summary generation process.
-    print('finished generating summaries')
-    return text_summaries
+    summaries = load_table_summaries(filename, tables) if os.path.exists(filename) else {}
+
+    # Identical tables (e.g. repeated on several pages) are summarized only once
+    missing = {table_hash(table): table for table in tables if table_hash(table) not in summaries}
+    print(f'{len(tables) - len(missing)} table summaries loaded from cache, {len(missing)} to generate')
+
+    if missing:
+        # Notify the start of summary generation process.
+        print('started generating summaries')
+        rate_limiter = RateLimiter(requests_per_minute)
+        cache_lock = threading.Lock()
+
+        def summarize(table):
+            # Format the prompt with the current table's data and invoke the language model.
+            filled_prompt = TABLE_SUMMARY_PROMPT.format(table=table)
+            return invoke_with_backoff(filled_prompt, rate_limiter=rate_limiter).content
 
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(summarize, table): key for key, table in missing.items()}
+            try:
+                for done, future in enumerate(as_completed(futures), start=1):
+                    with cache_lock:
+                        summaries[futures[future]] = future.result()
+                        if done % flush_every == 0:
+                            save_table_summaries(summaries, filename)
+                            print(f'{done}/{len(missing)} summaries generated')
+            finally:
+                # Keep whatever was generated, even if a request failed for good
+                save_table_summaries(summaries, filename)
 
+        # Notify the end of the summary generation process.
+        print('finished generating summaries')
+    else:
+        # Rewrites files still in the legacy list format with hash keys
+        save_table_summaries(summaries, filename)
 
+    return [summaries[table_hash(table)] for table in tables]
 
-def load_table_summaries(filename):
+
+
+
+def load_table_summaries(filename, tables=None):
     """
     Loads and returns table summaries from a specified JSON file.
 
+    Files written before summaries were keyed by table hash hold a plain list aligned with the tables.
+    Such a list is migrated when the matching tables are given and have the same length; otherwise it cannot
+    be matched safely and is ignored.
+
     Args:
         filename (str): The name of the JSON file from which to load the summaries.
+        tables (list, optional): The tables in CSV format, used to migrate the legacy list format.
 
     Returns:
-        list: A list of loaded table summaries.
+        dict: A mapping from table hash to summary.
     """
     with open(filename, 'r') as file:
         summaries = json.load(file)
-    return summaries
\ No newline at end of file
+
+    if isinstance(summaries, list):
+        if tables is not None and len(tables) == len(summaries):
+            return {table_hash(table): summary for table, summary in zip(tables, summaries)}
+        print(f'{filename} uses the legacy list format and does not match the tables, ignoring it')
+        return {}
+    return summaries
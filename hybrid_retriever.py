@@ -0,0 +1,141 @@
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from tracing import span
+from context_builder import page_key
+from config import http_pool_size, rrf_k
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # Shared by all hybrid retrievers; the dense leg mostly waits on the embedding API
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=http_pool_size, thread_name_prefix='dense_search')
+        return _executor
+
+
+def reciprocal_rank_fusion(result_lists, weights, k=60):
+    """
+    Fuses ranked result lists with weighted reciprocal rank fusion.
+
+    A document scores sum(weight / (k + rank)) over the lists it appears in, with ranks starting at 1.
+    Documents are identified by their content and page (see context_builder.page_key); ties keep the order of first appearance.
+
+    Args:
+        result_lists (List[List[Document]]): Ranked results of each retriever, best first.
+        weights (List[float]): Weight of each retriever.
+        k (int): Rank offset; larger values flatten the difference between top and lower ranks.
+
+    Returns:
+        List[Document]: The fused results, best first.
+    """
+    scores, documents = {}, {}
+    for results, weight in zip(result_lists, weights):
+        for rank, doc in enumerate(results, start=1):
+            key = (doc.page_content, page_key(doc))
+            documents.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+    return [documents[key] for key in sorted(scores, key=lambda key: -scores[key])]
+
+
+def dedupe_by_page(docs):
+    """
+    Keeps only the best ranked document of every page, since the context is built from whole pages.
+
+    Args:
+        docs (List[Document]): Documents, best first.
+
+    Returns:
+        List[Document]: One document per page, best first.
+    """
+    seen, unique = set(), []
+    for doc in docs:
+        page = page_key(doc)
+        if page not in seen:
+            seen.add(page)
+            unique.append(doc)
+    return unique
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Runs lexical and dense retrieval concurrently and fuses the results with reciprocal rank fusion.
+
+    The dense leg (query embedding round trip plus vector search) runs on a shared thread pool while the
+    lexical leg is scored in the calling thread, so the latency is the slower of the two legs instead of
+    their sum. Drop-in replacement for EnsembleRetriever([lexical, dense]) with the same invoke(query) interface.
+
+    Attributes:
+        lexical_retriever: The BM25 retriever.
+        dense_retriever: The vector store retriever.
+        weights (List[float]): Weights of the lexical and the dense results in the fusion.
+        rrf_k (int): Rank offset of the reciprocal rank fusion.
+        dedupe_pages (bool): Return only the best ranked document of every page.
+    """
+
+    lexical_retriever: Any
+    dense_retriever: Any
+    weights: List[float] = [0.5, 0.5]
+    rrf_k: int = 60
+    dedupe_pages: bool = True
+
+    def invoke_with_timings(self, query):
+        """
+        Retrieves the documents for a query and reports how long each leg took.
+
+        Args:
+            query (str): The user query.
+
+        Returns:
+            Tuple[List[Document], dict]: The fused documents and the wall time in seconds of the
+            'bm25', 'vector_search' and 'fusion' stages.
+        """
+        timings = {}
+
+        def timed(stage, retriever):
+            start_time = time.perf_counter()
+            with span(stage):
+                results = retriever.invoke(query)
+            timings[stage] = time.perf_counter() - start_time
+            return results
+
+        # The dense leg runs in a copy of the current context, so it records into the active trace
+        context = contextvars.copy_context()
+        dense_future = _get_executor().submit(context.run, timed, 'vector_search', self.dense_retriever)
+        lexical_results = timed('bm25', self.lexical_retriever)
+        dense_results = dense_future.result()
+
+        start_time = time.perf_counter()
+        with span('fusion'):
+            docs = self.fuse(lexical_results, dense_results)
+        timings['fusion'] = time.perf_counter() - start_time
+        return docs, timings
+
+    def fuse(self, lexical_results, dense_results):
+        """
+        Fuses the results of both legs for one query, also used by QueryEngine.retrieve_many.
+
+        Args:
+            lexical_results (List[Document]): The BM25 results, best first.
+            dense_results (List[Document]): The vector store results, best first.
+
+        Returns:
+            List[Document]: The fused documents, best first.
+        """
+        docs = reciprocal_rank_fusion([lexical_results, dense_results], self.weights, self.rrf_k)
+        if self.dedupe_pages:
+            docs = dedupe_by_page(docs)
+        return docs
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.invoke_with_timings(query)[0]
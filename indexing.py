@@ -1,50 +1,190 @@
-from langchain_chroma import Chroma
-from langchain_community.retrievers import BM25Retriever
 from data_prep import process_pdf
-from generate_table_summary import generate_and_save_table_summaries, load_table_summaries
-from config import llm, text_embeddings
-import os
-from config import manual_path, summary_filename, vector_store_path
+from bm25_index import build_and_save_bm25_index
+from product_codes import build_and_save_product_code_index
+from vector_index import FlatVectorIndex, load_vector_store
+from generate_table_summary import generate_and_save_table_summaries
+from config import text_embeddings
+import hashlib
+import time
+import argparse
+from config import manual_path, summary_filename, vector_store_path, bm25_index_path, embedding_batch_size
+from config import vector_backend, flat_index_path, product_code_index_path, document_store_path
+from tracing import tracer, span
 
 
+def _hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
-def prepare_documents_and_vector_store(pdf_path: str, summary_filename: str):
+
+def assign_chunk_ids(sub_documents):
+    """
+    Derives a stable ID for each sub-document from its page number, element type and source content.
+
+    The source content is the text as extracted from the PDF (the raw CSV for tables), so the ID of a chunk
+    does not change when only its table summary is regenerated. Identical elements on the same page get
+    an occurrence suffix to keep the IDs unique.
+
+    Args:
+        sub_documents (List[Document]): Sub-documents with their extracted content.
+
+    Returns:
+        List[str]: One ID per sub-document, in the same order.
     """
-    Processes a PDF file, generates or loads table summaries, and creates a vector store from the processed documents,
-    without returning any object.
+    ids, occurrences = [], {}
+    for doc in sub_documents:
+        base_id = _hash(f"{doc.metadata['page_number']}|{doc.metadata['element_type']}|{doc.page_content}")[:32]
+        occurrences[base_id] = occurrences.get(base_id, 0) + 1
+        ids.append(base_id if occurrences[base_id] == 1 else f"{base_id}-{occurrences[base_id]}")
+    return ids
+
+
+class SummarizedDocuments:
+    """
+    Read-only view of the sub-document store in which every table carries its summary as content, the text
+    that is embedded into the vector store.
+
+    Documents are decoded from the memory-mapped store when accessed, so the sub-documents are never all
+    held in memory at once.
+
+    Args:
+        sub_documents (DocumentStore): The sub-document store.
+        summaries (dict): Mapping from the row of a table sub-document to its summary.
+    """
+
+    def __init__(self, sub_documents, summaries):
+        self.sub_documents = sub_documents
+        self.summaries = summaries
+
+    def __len__(self):
+        return len(self.sub_documents)
+
+    def __getitem__(self, row):
+        doc = self.sub_documents[row]
+        if row in self.summaries:
+            doc.page_content = self.summaries[row]
+        return doc
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+
+def sync_vector_store(sub_documents, ids, vector_store_path, batch_size=embedding_batch_size):
+    """
+    Brings the Chroma collection in line with the current sub-documents, embedding only what changed.
+
+    Each chunk stores a hash of its embedded text in the 'content_hash' metadata field. Chunks with new IDs
+    are added, chunks whose embedded text changed (e.g. a regenerated table summary) are updated, and
+    chunks that no longer exist are deleted. Additions and updates are embedded and upserted in batches.
+
+    Args:
+        sub_documents (List[Document] or SummarizedDocuments): Sub-documents with the text to embed.
+        ids (List[str]): Stable chunk IDs from assign_chunk_ids.
+        vector_store_path (str): Persistent directory of the Chroma vector store.
+        batch_size (int): Number of chunks embedded and upserted per request.
+
+    Returns:
+        dict: Number of added, updated, deleted and unchanged chunks.
+    """
+    start_time = time.perf_counter()
+    vectordb = load_vector_store('chroma', text_embeddings, vector_store_path)
+
+    existing = vectordb.get(include=['metadatas'])
+    existing_hashes = {chunk_id: (metadata or {}).get('content_hash')
+                       for chunk_id, metadata in zip(existing['ids'], existing['metadatas'])}
+
+    content_hashes = [_hash(doc.page_content) for doc in sub_documents]
+
+    added = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing_hashes]
+    updated = [i for i, chunk_id in enumerate(ids)
+               if chunk_id in existing_hashes and existing_hashes[chunk_id] != content_hashes[i]]
+    current_ids = set(ids)
+    deleted = [chunk_id for chunk_id in existing_hashes if chunk_id not in current_ids]
+    unchanged = len(ids) - len(added) - len(updated)
+
+    for batch_start in range(0, len(deleted), batch_size):
+        vectordb.delete(ids=deleted[batch_start:batch_start + batch_size])
+
+    # add_documents upserts, so updated chunks replace their previous embedding
+    to_upsert = added + updated
+    for batch_start in range(0, len(to_upsert), batch_size):
+        batch = to_upsert[batch_start:batch_start + batch_size]
+        documents = [sub_documents[i] for i in batch]
+        for doc, i in zip(documents, batch):
+            doc.metadata['content_hash'] = content_hashes[i]
+        vectordb.add_documents(documents=documents, ids=[ids[i] for i in batch])
+        print(f"Upserted {min(batch_start + batch_size, len(to_upsert))}/{len(to_upsert)} chunks")
+
+    summary = {'added': len(added), 'updated': len(updated), 'deleted': len(deleted), 'unchanged': unchanged}
+    print(f"Vector store at {vector_store_path} synced in {time.perf_counter() - start_time:.1f}s: "
+          f"{summary['added']} added, {summary['updated']} updated, {summary['deleted']} deleted, {summary['unchanged']} unchanged")
+    return summary
+
+
+def prepare_documents_and_vector_store(pdf_path: str, summary_filename: str, force_refresh: bool = False,
+                                       document_store_dir: str = document_store_path, bm25_index_path: str = bm25_index_path,
+                                       product_code_index_path: str = product_code_index_path,
+                                       vector_store_path: str = flat_index_path if vector_backend == 'flat' else vector_store_path):
+    """
+    Processes a PDF file, generates or loads table summaries, and incrementally updates the vector store with the
+    processed documents, without returning any object.
+
+    The output paths default to the single manual configured in config.py; corpus.py passes the paths of a
+    manual's shard instead.
 
     Args:
         pdf_path (str): Path to the PDF file to be processed.
         summary_filename (str): File name for storing/loading the table summaries.
+        force_refresh (bool): Partition the PDF again instead of replaying the cached partition results.
+        document_store_dir (str): Directory of the page, sub-document and table stores.
+        bm25_index_path (str): Directory of the BM25 index.
+        product_code_index_path (str): JSON file of the product code index.
+        vector_store_path (str): Directory of the vector store of the backend selected in config.vector_backend.
     """
-    documents, sub_documents = process_pdf(pdf_path)
-    print(f"Processed {len(sub_documents)} documents.")
+    with tracer.trace('indexing', pdf_path=pdf_path):
+        with span('process_pdf'):
+            # Both stores are memory-mapped from disk, the sub-documents are decoded one at a time when read
+            documents, sub_documents = process_pdf(pdf_path, force_refresh=force_refresh, store_dir=document_store_dir)
+        print(f"Processed {len(sub_documents)} documents.")
 
-    table_texts = [doc.page_content for doc in sub_documents if doc.metadata['element_type'] == 'table']
+        # The lexical index covers the raw element text, exactly as stored in the sub-document store
+        with span('bm25_index'):
+            build_and_save_bm25_index(sub_documents, bm25_index_path)
+        # Product and type designations are extracted from the same raw text, including the table CSVs
+        with span('product_code_index'):
+            build_and_save_product_code_index(sub_documents, product_code_index_path)
 
-    if os.path.exists(summary_filename):
-        table_summaries = load_table_summaries(summary_filename)
-    else:
-        table_summaries = generate_and_save_table_summaries(table_texts, summary_filename)
+        # IDs are derived from the extracted content, before table contents are replaced by their summaries
+        chunk_ids = assign_chunk_ids(sub_documents)
 
-    print('Length of summaries is', len(table_summaries))
+        table_rows = [row for row, doc in enumerate(sub_documents) if doc.metadata['element_type'] == 'table']
 
-    summary_iter = iter(table_summaries)
+        # Summaries are cached by table content, so only new or changed tables are sent to the LLM
+        with span('table_summaries'):
+            table_summaries = generate_and_save_table_summaries([sub_documents.get_text(row) for row in table_rows], summary_filename)
 
-    for sub_document in sub_documents:
-        if sub_document.metadata['element_type'] == 'table':
-            sub_document.page_content = next(summary_iter)
+        print('Length of summaries is', len(table_summaries))
 
-    # Check if the vector store directory does not exist, then create the vector store
-    if not os.path.exists(vector_store_path):
-        vector_store = Chroma.from_documents(documents=sub_documents, persist_directory=vector_store_path, embedding=text_embeddings)
-        print(f"Vector store created at {vector_store_path}")
-    else:
-        print("Vector store directory already exists. Skipping creation.")
+        # Tables are embedded by their summary
+        embedded_documents = SummarizedDocuments(sub_documents, dict(zip(table_rows, table_summaries)))
+
+        with span('vector_store'):
+            if vector_backend == 'flat':
+                # Rewritten in full; the embedding cache makes unchanged chunks free to re-embed
+                start_time = time.perf_counter()
+                FlatVectorIndex.build(embedded_documents, chunk_ids).save(vector_store_path)
+                print(f"Flat vector index saved at {vector_store_path} in {time.perf_counter() - start_time:.1f}s")
+            else:
+                # Embed and upsert only new or changed chunks, and delete chunks that no longer exist
+                sync_vector_store(embedded_documents, chunk_ids, vector_store_path)
 
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index the manual for retrieval.")
+    parser.add_argument('--refresh-partitions', action='store_true', help="Partition the PDF again, ignoring cached partition results.")
+    args = parser.parse_args()
+
     # Provide the path to the PDF file to process.
     pdf_path = manual_path
-    prepare_documents_and_vector_store(pdf_path, summary_filename)
\ No newline at end of file
+    prepare_documents_and_vector_store(pdf_path, summary_filename, force_refresh=args.refresh_partitions)
\ No newline at end of file
@@ -0,0 +1,84 @@
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+class JudgeCache:
+    """
+    Persistent cache of the evaluation scores given by the LLM judge.
+
+    A score is keyed by a hash of the query, the reference answer and the generated answer, together with the
+    judge model and the evaluation prompt template, so an unchanged answer is never judged twice while a changed
+    answer, judge or prompt is always judged again. Entries do not expire: the judge is asked for a deterministic
+    0 or 1 score.
+
+    Args:
+        cache_path (str): Path to the SQLite file holding the cache.
+        judge_name (str): Name of the judge model.
+        prompt_template (str): The evaluation prompt template.
+    """
+
+    def __init__(self, cache_path='judge_cache.sqlite', judge_name='', prompt_template=''):
+        self.cache_path = cache_path
+        self.judge_name = judge_name
+        self.prompt_hash = hashlib.sha256(prompt_template.encode('utf-8')).hexdigest()
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score INTEGER, created_at REAL)")
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, query, reference_answer, generated_answer):
+        payload = json.dumps([self.judge_name, self.prompt_hash, query, reference_answer, generated_answer], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, query, reference_answer, generated_answer):
+        """
+        Looks up the score of a generated answer.
+
+        Args:
+            query (str): The evaluation query.
+            reference_answer (str): The reference answer.
+            generated_answer (str): The generated answer.
+
+        Returns:
+            int or None: The cached score, or None on a miss.
+        """
+        key = self._key(query, reference_answer, generated_answer)
+        with self._lock:
+            row = self._connection.execute("SELECT score FROM scores WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, query, reference_answer, generated_answer, score):
+        """
+        Stores the score of a generated answer.
+
+        Args:
+            query (str): The evaluation query.
+            reference_answer (str): The reference answer.
+            generated_answer (str): The generated answer.
+            score (int): The score given by the judge.
+        """
+        key = self._key(query, reference_answer, generated_answer)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO scores (key, score, created_at) VALUES (?, ?, ?)",
+                                     (key, int(score), time.time()))
+            self._connection.commit()
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Hits, misses and the number of stored scores.
+        """
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
@@ -0,0 +1,72 @@
+import time
+import random
+import threading
+from config import llm
+from tracing import current_trace
+
+
+def is_rate_limit_error(error):
+    """
+    Checks whether an exception raised by an LLM client signals a rate limit (HTTP 429).
+
+    Args:
+        error (Exception): The exception raised by the client.
+
+    Returns:
+        bool: True if the request should be retried after backing off.
+    """
+    status_code = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code == 429 or 'rate limit' in str(error).lower() or type(error).__name__ == 'RateLimitError'
+
+
+def invoke_with_backoff(prompt, max_retries=6, base_delay=2.0, max_delay=60.0, rate_limiter=None):
+    """
+    Invokes the LLM and retries with exponential backoff and jitter when the provider rate limits the request.
+
+    Args:
+        prompt (str): The filled prompt.
+        max_retries (int): Maximum number of retries after a rate limit error.
+        base_delay (float): Delay in seconds before the first retry, doubled on every further retry.
+        max_delay (float): Upper bound of the delay in seconds.
+        rate_limiter (RateLimiter, optional): Limiter every attempt has to pass before it is sent.
+
+    Returns:
+        The LLM response message.
+    """
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            return llm.invoke(prompt)
+        except Exception as e:
+            if attempt == max_retries or not is_rate_limit_error(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            current_trace().increment('retries')
+            print(f"Rate limited, retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
+            time.sleep(delay)
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces out request starts so that at most requests_per_minute are sent.
+
+    Args:
+        requests_per_minute (float): Maximum number of requests started per minute.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        """
+        Blocks until the calling thread may send its request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
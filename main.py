@@ -1,17 +1,56 @@
-from langchain_chroma import Chroma
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
-from data_prep import prepare_context_for_generation
+import time
 from config import llm, text_embeddings
-from prompts import RESPONSE_GENERATION_PROMPT
-import os
-from data_prep import load_documents_from_json
-import json
-from langchain_core.documents import Document
 import streamlit as st
-from config import vector_store_path, k_value
+from config import k_value, answer_cache_path, answer_cache_ttl, answer_cache_max_entries, answer_cache_semantic_threshold
+from corpus import open_query_engine
+from context_builder import format_page_reference
+from answer_cache import AnswerCache
+from tracing import tracer, span, record, record_usage
 
 
+@st.cache_resource
+def get_query_engine():
+    """
+    Builds the retrieval stack once per process; Streamlit shares it across sessions and reruns.
+    The multi-manual corpus is served if one has been built with corpus.py, otherwise the single manual.
+    """
+    return open_query_engine()
+
+
+@st.cache_resource
+def get_answer_cache():
+    """
+    Opens the persistent answer cache once per process, shared across sessions.
+    """
+    return AnswerCache(answer_cache_path, ttl=answer_cache_ttl, max_entries=answer_cache_max_entries,
+                       semantic_threshold=answer_cache_semantic_threshold)
+
+
+def stream_response(filled_prompt, timings):
+    """
+    Streams the answer tokens from the chat model and records time-to-first-token and total generation time.
+
+    Args:
+        filled_prompt (str): The filled generation prompt.
+        timings (dict): Receives 'first_token' and 'total' in seconds, measured from the start of the generation.
+    """
+    start_time = time.perf_counter()
+    with span('llm'):
+        for chunk in llm.stream(filled_prompt):
+            # The usage counts arrive with the last chunk
+            record_usage(chunk)
+            if chunk.content:
+                timings.setdefault('first_token', time.perf_counter() - start_time)
+                yield chunk.content
+    timings['total'] = time.perf_counter() - start_time
+    record(generation_ms=round(timings['total'] * 1000, 3))
+    if 'first_token' in timings:
+        record(first_token_ms=round(timings['first_token'] * 1000, 3))
+
+
+query_engine = get_query_engine()
+answer_cache = get_answer_cache()
+
 st.title("RAG System")
 st.write("Submit your query below.")
 
@@ -21,47 +60,51 @@ query = st.text_input("Enter your query:", "")
 if st.button("Get Answer"):
     if query.strip():
         try:
-            # Load VectorDB
-            vectordb = Chroma(persist_directory=vector_store_path, embedding_function=text_embeddings)
-            sub_documents = load_documents_from_json('sub_documents.json')
-            documents = load_documents_from_json('documents.json')
-
-            # Define retrievers
-            docs_retriever = vectordb.as_retriever()
-            bm25_retriever = BM25Retriever.from_documents(sub_documents)
-            ensemble_retriever = EnsembleRetriever(retrievers=[bm25_retriever, docs_retriever], weights=[0.5, 0.5])
-
-            # Handle context limit with dynamic k_value adjustment
-            response_content = ""
-
-            while k_value > 0:
-                try:
-                    docs_retriever.search_kwargs["k"] = k_value
-                    retrieved_docs = ensemble_retriever.invoke(query)
-
-                    # Prepare context
-                    context = prepare_context_for_generation(retrieved_docs, documents)
-
-                    # Generate response
-                    filled_prompt = RESPONSE_GENERATION_PROMPT.format(context=context, question=query)
-                    response = llm.invoke(filled_prompt)
-                    response_content = response.content
-                    break
-                except Exception as e:
-                    if k_value > 2:
-                        k_value -= 2
-                    else:
-                        response_content = "Unable to generate response due to context limitations."
-                        raise e
-
-            # Display the response
-            if response_content:
+            with tracer.trace('query', query=query):
+                request_start = time.perf_counter()
+                retrieved_docs = query_engine.retrieve(query, k=k_value)
+
+                # Prepare context, packed into the token budget of the LLM so a single call is enough
+                packed = query_engine.build_context(retrieved_docs, query, query_engine.response_prompt)
+
+                # Show the page references as soon as retrieval is done, before the answer is generated
+                st.subheader("Sources:")
+                st.write(", ".join(format_page_reference(page) for page in packed.pages))
+                st.caption(f"Context: {len(packed.pages)} pages, {packed.tokens} tokens ({packed.tokens_saved} tokens saved by page deduplication and packing).")
+
+                # Reuse the answer of an identical or near-duplicate query over the same pages.
+                # The query embedding was already computed for retrieval and comes from the embedding cache;
+                # queries resolved through the product code index skip it and only use exact hits.
+                code_lookup = bool(retrieved_docs) and all(doc.metadata.get('retrieval') == 'product_code' for doc in retrieved_docs)
+                query_embedding = text_embeddings.embed_query(query) if answer_cache_semantic_threshold is not None and not code_lookup else None
+                response_content = answer_cache.get(query, packed.pages, query_embedding)
+
                 st.subheader("Generated Response:")
-                st.write(response_content)
+                if response_content is None:
+                    # Generate response, rendering the tokens as they arrive
+                    filled_prompt = query_engine.response_prompt.format(context=packed.context, question=query)
+                    timings = {}
+                    generation_start = time.perf_counter()
+                    response_content = st.write_stream(stream_response(filled_prompt, timings))
+                    if response_content:
+                        answer_cache.put(query, packed.pages, response_content, query_embedding)
+                    st.caption(f"Retrieval {generation_start - request_start:.2f}s, "
+                               f"first token after {timings.get('first_token', float('nan')):.2f}s, "
+                               f"generation {timings.get('total', float('nan')):.2f}s, "
+                               f"total {time.perf_counter() - request_start:.2f}s.")
+                else:
+                    st.write(response_content)
+                    st.caption(f"Answer served from cache in {time.perf_counter() - request_start:.2f}s.")
+                    record(answer_cache_hit=True)
 
         except Exception as e:
             st.error(f"An error occurred: {e}")
     else:
         st.warning("Please enter a query to get a response.")
 
-st.write("\n\n*Note: This system retrieves relevant chunks and dynamically adjusts context size to handle LLM limitations and generate responses based on the provided query.")
\ No newline at end of file
+if st.sidebar.button("Reload index"):
+    # Pick up a rebuilt vector store or regenerated JSON artifacts without restarting the app
+    query_engine.reload()
+    st.sidebar.success("Index reloaded.")
+
+st.write("\n\n*Note: This system retrieves relevant chunks and packs their pages into the token budget of the LLM to generate responses based on the provided query.")
\ No newline at end of file
@@ -0,0 +1,100 @@
+import os
+import gzip
+import json
+import hashlib
+import threading
+
+
+def file_hash(file_name, chunk_size=1 << 20):
+    """
+    Computes the SHA-256 hash of a file's content.
+
+    Args:
+        file_name (str): The path to the file.
+        chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PartitionCache:
+    """
+    On-disk cache of raw Aryn partition results, one gzip-compressed JSON file per partitioned shard.
+
+    An entry is keyed by the content hash of the PDF and the partition options, including the page range of
+    the shard, so a changed manual or changed OCR settings are partitioned again while filtering, table
+    extraction and document construction can be replayed from the cache without calling Aryn.
+
+    Args:
+        cache_dir (str): Directory holding the cached partition results.
+    """
+
+    def __init__(self, cache_dir='partition_cache'):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @staticmethod
+    def key(pdf_hash, options):
+        """
+        Derives the cache key of a partition request.
+
+        Args:
+            pdf_hash (str): Content hash of the PDF file (see file_hash).
+            options (dict): The options passed to partition_file, e.g. the selected pages.
+
+        Returns:
+            str: The cache key.
+        """
+        return hashlib.sha256(json.dumps({'pdf': pdf_hash, 'options': options}, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json.gz")
+
+    def get(self, key):
+        """
+        Returns the cached partition result, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as cache_file:
+                partitioned_file = json.load(cache_file)
+        except (OSError, EOFError, json.JSONDecodeError):
+            # Missing, or cut off by an interrupted write
+            partitioned_file = None
+        with self._lock:
+            if partitioned_file is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return partitioned_file
+
+    def put(self, key, partitioned_file):
+        """
+        Stores a partition result, written next to its target and then swapped in.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8') as cache_file:
+            json.dump(partitioned_file, cache_file)
+        os.replace(f"{path}.tmp", path)
+        with self._lock:
+            self.writes += 1
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Hits, misses and newly stored results since the cache was created.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'writes': self.writes}
@@ -0,0 +1,218 @@
+import os
+import re
+import json
+from dataclasses import dataclass, field
+from typing import List
+from document_store import document_fingerprint
+
+
+# Type designations such as 'K-O-M4-V3', 'H-NN1' or 'Q-PZ': uppercase segments joined by hyphens
+_CODE_RE = re.compile(r"(?<![\w-])[A-Z][A-Z0-9]{0,5}(?:-[A-Z0-9]{1,6})+(?![\w-])")
+# Single-letter types only count after 'Typ', e.g. 'Typ H'
+_TYPE_RE = re.compile(r"\b[Tt][Yy][Pp]\s+([A-Za-z](?:-[A-Za-z0-9]{1,6})*)(?![\w-])")
+
+
+def extract_codes(text):
+    """
+    Extracts product and type designations from a text.
+
+    Args:
+        text (str): A sub-document, table CSV or query.
+
+    Returns:
+        List[str]: The designations in order of appearance, in uppercase.
+    """
+    codes = [match.group() for match in _CODE_RE.finditer(text)]
+    codes.extend(extract_type_codes(text))
+    return codes
+
+
+def extract_type_codes(text):
+    """
+    Extracts the designations written after 'Typ', such as 'Typ H' or 'Typ k-o', in uppercase.
+    """
+    return [match.group(1).upper() for match in _TYPE_RE.finditer(text)]
+
+
+def _is_code_segment(segment):
+    # Designation segments are short ('K', 'NN1', 'M4'), longer all-letter segments are words ('WERT')
+    return len(segment) <= 3 or any(char.isdigit() for char in segment)
+
+
+def extract_query_codes(query):
+    """
+    Extracts product and type designations from a query, which is often typed in lowercase.
+
+    Designations written in uppercase are taken as they are. In the uppercased query only hyphenated words
+    whose every segment has at most three letters or contains a digit count, so that words such as
+    'K-Wert' or 'Q-Werte' are not taken for designations.
+
+    Args:
+        query (str): The user query.
+
+    Returns:
+        List[str]: The distinct designations, in uppercase.
+    """
+    codes = extract_codes(query)
+    codes.extend(code for code in extract_codes(query.upper()) if all(_is_code_segment(segment) for segment in code.split('-')))
+    return list(dict.fromkeys(codes))
+
+
+@dataclass
+class CodeMatch:
+    """
+    A designation found in a query and the pages it resolves to.
+
+    Attributes:
+        code (str): The designation as written in the query.
+        indexed_code (str): The indexed designation it resolved to, the code itself or its longest indexed prefix.
+        pages (List[int]): Pages mentioning the indexed designation, most mentions first.
+    """
+    code: str
+    indexed_code: str
+    pages: List[int] = field(default_factory=list)
+
+    @property
+    def exact(self):
+        return self.code == self.indexed_code
+
+
+class ProductCodeIndex:
+    """
+    Inverted index from product and type designations to the pages that mention them.
+
+    Args:
+        code_pages (dict): Mapping from designation to a {page_number: number of sub-documents mentioning it} mapping.
+        num_docs (int): Number of sub-documents the index was built from, used to detect a stale index.
+        fingerprint (str, optional): document_store.document_fingerprint of those sub-documents, also used to detect a stale index.
+    """
+
+    def __init__(self, code_pages, num_docs, fingerprint=None):
+        self.code_pages = code_pages
+        self.num_docs = num_docs
+        self.fingerprint = fingerprint
+        # Pages ordered by the number of mentions, ties by page number
+        self._ranked_pages = {code: sorted(pages, key=lambda page: (-pages[page], page)) for code, pages in code_pages.items()}
+
+    @classmethod
+    def build(cls, sub_documents):
+        """
+        Builds the index over the raw text of the sub-documents, including the table CSVs.
+
+        Args:
+            sub_documents (List[Document] or DocumentStore): The sub-documents.
+
+        Returns:
+            ProductCodeIndex: The built index.
+        """
+        code_pages = {}
+        num_docs = 0
+        for doc in sub_documents:
+            num_docs += 1
+            page_number = doc.metadata['page_number']
+            for code in set(extract_codes(doc.page_content)):
+                pages = code_pages.setdefault(code, {})
+                pages[page_number] = pages.get(page_number, 0) + 1
+        return cls(code_pages, num_docs)
+
+    def save(self, path):
+        """
+        Writes the index as JSON.
+
+        Args:
+            path (str): Path of the JSON file.
+        """
+        with open(f"{path}.tmp", 'w') as json_file:
+            json.dump({'num_docs': self.num_docs, 'fingerprint': self.fingerprint,
+                       'codes': {code: {str(page): count for page, count in pages.items()} for code, pages in self.code_pages.items()}},
+                      json_file)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index written by save().
+
+        Args:
+            path (str): Path of the JSON file.
+
+        Returns:
+            ProductCodeIndex: The loaded index.
+        """
+        with open(path, 'r') as json_file:
+            data = json.load(json_file)
+        code_pages = {code: {int(page): count for page, count in pages.items()} for code, pages in data['codes'].items()}
+        return cls(code_pages, data['num_docs'], data.get('fingerprint'))
+
+    def resolve(self, code, min_segments=2):
+        """
+        Resolves a designation to itself or, for a variant that is not in the manual such as 'K-O-M4-V3',
+        to its longest indexed prefix such as 'K-O'.
+
+        Args:
+            code (str): The designation, in uppercase.
+            min_segments (int): Fewest segments of a prefix; single letters such as 'K' are only meaningful after 'Typ'.
+
+        Returns:
+            str or None: The indexed designation, or None if no prefix is indexed either.
+        """
+        segments = code.split('-')
+        for end in range(len(segments), min(min_segments, len(segments)) - 1, -1):
+            prefix = '-'.join(segments[:end])
+            if prefix in self.code_pages:
+                return prefix
+        return None
+
+    def lookup(self, query):
+        """
+        Finds the designations in a query and the pages they resolve to.
+
+        Args:
+            query (str): The user query.
+
+        Returns:
+            List[CodeMatch]: One match per distinct designation that resolved to indexed pages.
+        """
+        matches = []
+        type_codes = set(extract_type_codes(query))
+        for code in extract_query_codes(query):
+            indexed_code = self.resolve(code, min_segments=1 if code in type_codes else 2)
+            if indexed_code is not None:
+                matches.append(CodeMatch(code, indexed_code, self._ranked_pages[indexed_code]))
+        return matches
+
+
+def build_and_save_product_code_index(sub_documents, path):
+    """
+    Builds the product code index over a list of sub-documents and writes it to disk.
+
+    Args:
+        sub_documents (List[Document] or DocumentStore): The sub-documents, with the raw table CSVs.
+        path (str): Path of the JSON file.
+
+    Returns:
+        ProductCodeIndex: The built index.
+    """
+    index = ProductCodeIndex.build(sub_documents)
+    index.fingerprint = document_fingerprint(sub_documents)
+    index.save(path)
+    print(f"Product code index with {len(index.code_pages)} designations saved at {path}")
+    return index
+
+
+def load_product_code_index(path, sub_documents):
+    """
+    Loads the product code index, building and saving it first if it does not exist or no longer
+    matches the sub-documents.
+
+    Args:
+        path (str): Path of the JSON file.
+        sub_documents (List[Document] or DocumentStore): The indexed sub-documents.
+
+    Returns:
+        ProductCodeIndex: The index.
+    """
+    index = ProductCodeIndex.load(path) if os.path.exists(path) else None
+    if index is None or index.num_docs != len(sub_documents) or index.fingerprint != document_fingerprint(sub_documents):
+        index = build_and_save_product_code_index(sub_documents, path)
+    return index
@@ -21,6 +21,18 @@ Question: {question}
 
 
 
+CORPUS_RESPONSE_GENERATION_PROMPT = """
+Answer the question based only on the following context, taken from several product manuals. Each section of the context is labeled with a page number and the manual it comes from, for example, 'Page X (manual):', followed by the content:
+{context}
+When answering, please reference these pages to indicate the source of your information. Ensure your response is clear and provides relevant explanations without unnecessary details.
+If the context does not contain relevant information to answer the query, respond with: "Entschuldigung, ich kann diese Anfrage nicht beantworten." Do not use any internal knowledge outside of the provided context.
+Include the reference(s) like this- [page_num:54, manual:name][page_num:78, manual:name]. Please return your answer in German only. Don't Just mention the page numbers without answering, mention them if you answer the query.
+
+Question: {question}
+"""
+
+
+
 EVALUATION_PROMPT = """
 Your task is to evaluate responses from the RAG pipeline for a given query. You will be provided with the following information:
 
@@ -0,0 +1,168 @@
+import threading
+
+
+_factories = {}
+_instances = {}
+_overrides = {}
+_sessions = {}
+_lock = threading.RLock()
+
+
+def register_provider(kind, name):
+    """
+    Registers a factory that creates the client of a backend.
+
+    Factories import their client library themselves, so a backend costs nothing until it is first used.
+
+    Args:
+        kind (str): Kind of client, 'llm' or 'embeddings'.
+        name (str): Name of the backend, selected by config.llm_provider or config.embedding_provider.
+
+    Returns:
+        Callable: Decorator registering the factory.
+    """
+    def decorator(factory):
+        _factories[(kind, name)] = factory
+        return factory
+    return decorator
+
+
+def get_provider(kind, name=None):
+    """
+    Returns the client of a backend, creating it on first use.
+
+    Args:
+        kind (str): Kind of client, 'llm' or 'embeddings'.
+        name (str, optional): Name of the backend, defaults to the one selected in config.
+
+    Returns:
+        The client, shared by all callers of the process.
+    """
+    with _lock:
+        if name is None and kind in _overrides:
+            return _overrides[kind]
+        if name is None:
+            import config
+            name = config.llm_provider if kind == 'llm' else config.embedding_provider
+        client = _instances.get((kind, name))
+        if client is None:
+            if (kind, name) not in _factories:
+                available = sorted(backend for registered_kind, backend in _factories if registered_kind == kind)
+                raise ValueError(f"Unknown {kind} provider '{name}', expected one of {available}")
+            client = _factories[(kind, name)]()
+            _instances[(kind, name)] = client
+        return client
+
+
+def set_provider(kind, client):
+    """
+    Replaces the configured client of a kind, e.g. with a local stand-in in benchmark.py.
+
+    Args:
+        kind (str): Kind of client, 'llm' or 'embeddings'.
+        client: The client to use from now on, or None to go back to the configured backend.
+    """
+    with _lock:
+        if client is None:
+            _overrides.pop(kind, None)
+        else:
+            _overrides[kind] = client
+
+
+def resolved_provider(kind):
+    """
+    Returns the name of the backend that get_provider(kind) resolves to.
+
+    Args:
+        kind (str): Kind of client, 'llm' or 'embeddings'.
+
+    Returns:
+        str or None: Name of the configured backend, or None while set_provider() overrides the kind.
+    """
+    with _lock:
+        if kind in _overrides:
+            return None
+    import config
+    return config.llm_provider if kind == 'llm' else config.embedding_provider
+
+
+def http_session(backend, pool_size):
+    """
+    Returns the pooled requests session of a backend, so that all calls to it reuse open connections.
+
+    Args:
+        backend (str): Name of the backend.
+        pool_size (int): Maximum number of connections kept open, at least the number of concurrent callers.
+
+    Returns:
+        requests.Session: The shared session.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _lock:
+        session = _sessions.get(backend)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[backend] = session
+        return session
+
+
+class LazyClient:
+    """
+    Stand-in that resolves the configured client of a kind on first attribute access.
+
+    config.llm and config.text_embeddings are LazyClients, so importing config neither imports the client
+    libraries nor creates any client, and set_provider() takes effect for modules that imported them earlier.
+
+    Args:
+        kind (str): Kind of client, 'llm' or 'embeddings'.
+    """
+
+    def __init__(self, kind):
+        self._kind = kind
+
+    def __getattr__(self, name):
+        return getattr(get_provider(self._kind), name)
+
+    def __repr__(self):
+        return f"LazyClient({self._kind!r})"
+
+
+@register_provider('llm', 'groq')
+def _groq_llm():
+    import httpx
+    from langchain_groq import ChatGroq
+    import config
+    limits = httpx.Limits(max_connections=config.http_pool_size, max_keepalive_connections=config.http_pool_size)
+    return ChatGroq(temperature=0, groq_api_key=config.groq_api_key, model_name=config.llm_name,
+                    http_client=httpx.Client(limits=limits))
+
+
+@register_provider('llm', 'azure')
+def _azure_llm():
+    # Endpoint, key and API version are read from the AZURE_OPENAI_* environment variables
+    from langchain_openai import AzureChatOpenAI
+    import config
+    return AzureChatOpenAI(temperature=0, azure_deployment=config.llm_name)
+
+
+@register_provider('embeddings', 'jina')
+def _jina_embeddings():
+    from langchain_community.embeddings import JinaEmbeddings
+    import config
+    embeddings = JinaEmbeddings(jina_api_key=config.jina_api_key, model_name=config.Embedding_model)
+    # Keep the authentication headers, but send them over the pooled session
+    session = http_session('jina', config.http_pool_size)
+    session.headers.update(embeddings.session.headers)
+    embeddings.session = session
+    return embeddings
+
+
+@register_provider('embeddings', 'azure')
+def _azure_embeddings():
+    from langchain_openai import AzureOpenAIEmbeddings
+    import config
+    return AzureOpenAIEmbeddings(azure_deployment=config.Embedding_model)
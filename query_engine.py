@@ -0,0 +1,283 @@
+import os
+import threading
+import numpy as np
+from vector_index import load_vector_store
+from hybrid_retriever import HybridRetriever
+from document_store import open_document_store
+from bm25_index import load_bm25_retriever
+from product_codes import load_product_code_index, extract_codes
+from table_store import open_table_store, SlicedPageMap
+from context_builder import pack_context, context_token_budget
+from prompts import RESPONSE_GENERATION_PROMPT
+from tracing import span, record, traced_embeddings
+from config import text_embeddings, vector_backend, bm25_index_path, document_store_path, k_value
+from config import product_code_index_path, product_code_max_pages, retriever_weights, rrf_k, retrieval_dedupe_pages
+from config import table_max_rows
+
+
+class QueryEngine:
+    """
+    Long-lived retrieval stack that is built once per process and shared across sessions and reruns.
+
+    The engine owns the vector store, the BM25 index, the product code index, the page map and table store
+    used for context preparation and the hybrid retrievers. All of these are treated as read-only once built, so a single engine
+    can be queried from multiple threads. Calling reload() rebuilds everything from disk and swaps it in
+    atomically, which is needed whenever the index directory or the JSON artifacts change.
+
+    Args:
+        vector_backend (str): Vector store backend, 'chroma' or 'flat' (see vector_index.load_vector_store).
+        bm25_index_path (str): Directory of the precomputed BM25 index written by indexing.py.
+        documents_path (str): Legacy JSON file of the page-level documents, migrated if the page store is missing.
+        sub_documents_path (str): Legacy JSON file of the sub-documents, migrated if the sub-document store is missing.
+        embeddings: Embedding function used by the vector store for query embedding.
+        weights (list): Weights of the BM25 and vector results in the rank fusion.
+        vector_store_path (str, optional): Directory of the vector store, defaults to the one configured for the backend.
+        document_store_dir (str): Directory holding the page and sub-document stores.
+        product_code_index_path (str): JSON file of the product code index written by indexing.py.
+        rrf_k (int): Rank offset of the reciprocal rank fusion.
+    """
+
+    # Generation prompt matching the page labels of build_context()
+    response_prompt = RESPONSE_GENERATION_PROMPT
+
+    def __init__(self, vector_backend=vector_backend, bm25_index_path=bm25_index_path, documents_path='documents.json',
+                 sub_documents_path='sub_documents.json', embeddings=text_embeddings, weights=retriever_weights,
+                 vector_store_path=None, document_store_dir=document_store_path, product_code_index_path=product_code_index_path,
+                 rrf_k=rrf_k):
+        self.vector_backend = vector_backend
+        self.bm25_index_path = bm25_index_path
+        self.documents_path = documents_path
+        self.sub_documents_path = sub_documents_path
+        self.embeddings = embeddings
+        self.weights = list(weights)
+        self.rrf_k = rrf_k
+        self.vector_store_path = vector_store_path
+        self.document_store_dir = document_store_dir
+        self.product_code_index_path = product_code_index_path
+
+        self._lock = threading.RLock()
+        self._retrievers = {}
+        self.reload()
+
+    def reload(self):
+        """
+        Rebuilds the vector store handle, the BM25 index and the page map from disk.
+
+        The new objects are constructed before taking the lock, so queries that are already running keep
+        using the previous state and never see a half-built engine.
+        """
+        vectordb = load_vector_store(self.vector_backend, traced_embeddings(self.embeddings), self.vector_store_path)
+        # Both stores are memory-mapped; legacy JSON files are migrated on first use
+        sub_documents = open_document_store('sub_documents', self.sub_documents_path, self.document_store_dir)
+        documents = open_document_store('pages', self.documents_path, self.document_store_dir)
+        bm25_retriever = load_bm25_retriever(self.bm25_index_path, sub_documents)
+        code_index = load_product_code_index(self.product_code_index_path, sub_documents)
+        table_store = open_table_store(os.path.join(self.document_store_dir, 'tables.json'), sub_documents)
+        page_to_content = documents.pages()
+
+        with self._lock:
+            self.vectordb = vectordb
+            self.sub_documents = sub_documents
+            self.documents = documents
+            self.bm25_retriever = bm25_retriever
+            self.code_index = code_index
+            self.table_store = table_store
+            self.page_to_content = page_to_content
+            self._retrievers = {}
+
+        print(f"Query engine loaded {len(documents)} pages and {len(sub_documents)} sub-documents.")
+
+    def get_retriever(self, k=k_value):
+        """
+        Returns the hybrid retriever for a given number of vector-store results.
+
+        Retrievers are created once per k and cached, instead of mutating search_kwargs on a shared
+        retriever, so concurrent queries with different k values do not interfere with each other.
+
+        Args:
+            k (int): Number of chunks to retrieve from the vector store.
+
+        Returns:
+            HybridRetriever: The BM25 + vector store retriever, both legs run concurrently.
+        """
+        with self._lock:
+            hybrid_retriever = self._retrievers.get(k)
+            if hybrid_retriever is None:
+                docs_retriever = self.vectordb.as_retriever(search_kwargs={"k": k})
+                hybrid_retriever = HybridRetriever(lexical_retriever=self.bm25_retriever, dense_retriever=docs_retriever,
+                                                   weights=self.weights, rrf_k=self.rrf_k, dedupe_pages=retrieval_dedupe_pages)
+                self._retrievers[k] = hybrid_retriever
+            return hybrid_retriever
+
+    def configure_fusion(self, weights=None, rrf_k=None):
+        """
+        Changes the rank fusion settings of the retrievers, e.g. to sweep them during evaluation.
+
+        The cached retrievers are dropped, so the next query creates them with the new settings.
+
+        Args:
+            weights (list, optional): Weights of the BM25 and vector results, unchanged if None.
+            rrf_k (int, optional): Rank offset of the reciprocal rank fusion, unchanged if None.
+        """
+        with self._lock:
+            if weights is not None:
+                self.weights = list(weights)
+            if rrf_k is not None:
+                self.rrf_k = rrf_k
+            self._retrievers = {}
+
+    def retrieve(self, query, k=k_value):
+        """
+        Retrieves the sub-documents relevant to a query.
+
+        Queries naming product or type designations are resolved through the product code index first.
+        If every designation is known exactly and together they appear on at most product_code_max_pages
+        pages, those pages are returned directly, without the embedding call and the hybrid search.
+        Otherwise the hybrid search results are boosted: the best pages of the designations are put first,
+        followed by the results on pages mentioning them and then the remaining results.
+
+        Args:
+            query (str): The user query.
+            k (int): Number of chunks to retrieve from the vector store.
+
+        Returns:
+            List[Document]: The retrieved sub-documents, best first. Documents found through the product code
+            index carry 'retrieval': 'product_code' in their metadata.
+        """
+        with span('retrieval'):
+            with self._lock:
+                code_index, sub_documents = self.code_index, self.sub_documents
+            matches, candidate_pages, code_docs = self._route(code_index, sub_documents, query)
+            if code_docs is not None:
+                return code_docs
+            return self._boost(sub_documents, matches, candidate_pages, self.get_retriever(k).invoke(query))
+
+    def retrieve_many(self, queries, k=k_value):
+        """
+        Retrieves the sub-documents relevant to each of a batch of queries, e.g. all questions of an evaluation.
+
+        The queries that are not answered through the product code index are embedded with a single batched
+        request, the BM25 index scores all of them in one sparse product and the flat vector index in one
+        matrix multiply (Chroma is searched per query embedding). Every query gets the same ranked results
+        as retrieve().
+
+        Args:
+            queries (List[str]): The user queries.
+            k (int): Number of chunks to retrieve from the vector store per query.
+
+        Returns:
+            List[List[Document]]: The retrieved sub-documents of every query, best first.
+        """
+        with span('retrieval'):
+            with self._lock:
+                code_index, sub_documents, vectordb = self.code_index, self.sub_documents, self.vectordb
+            hybrid_retriever = self.get_retriever(k)
+
+            results, routes, pending = [None] * len(queries), {}, []
+            for index, query in enumerate(queries):
+                matches, candidate_pages, code_docs = self._route(code_index, sub_documents, query)
+                if code_docs is None:
+                    routes[index] = (matches, candidate_pages)
+                    pending.append(index)
+                else:
+                    results[index] = code_docs
+            if not pending:
+                return results
+
+            pending_queries = [queries[index] for index in pending]
+            with span('query_embedding'):
+                if hasattr(self.embeddings, 'embed_queries'):
+                    query_vectors = self.embeddings.embed_queries(pending_queries)
+                else:
+                    query_vectors = [self.embeddings.embed_query(query) for query in pending_queries]
+            with span('vector_search'):
+                dense_results = self._search_by_vectors(vectordb, query_vectors, k)
+            with span('bm25'):
+                lexical_results = hybrid_retriever.lexical_retriever.batch_retrieve(pending_queries)
+            with span('fusion'):
+                for index, lexical_docs, dense_docs in zip(pending, lexical_results, dense_results):
+                    matches, candidate_pages = routes[index]
+                    results[index] = self._boost(sub_documents, matches, candidate_pages,
+                                                 hybrid_retriever.fuse(lexical_docs, dense_docs))
+            return results
+
+    @staticmethod
+    def _search_by_vectors(vectordb, query_vectors, k):
+        """
+        Returns the k most similar sub-documents for each query embedding.
+        """
+        if hasattr(vectordb, 'search_by_vectors'):
+            rows, _ = vectordb.search_by_vectors(query_vectors, k)
+            return [[vectordb.documents[row] for row in query_rows] for query_rows in rows]
+        return [vectordb.similarity_search_by_vector(vector, k=k) for vector in query_vectors]
+
+    def _route(self, code_index, sub_documents, query):
+        """
+        Resolves the designations in a query. Returns the matches, the pages mentioning them and, if the
+        query can be answered from those pages alone, their sub-documents (otherwise None).
+        """
+        matches = code_index.lookup(query)
+        candidate_pages = list(dict.fromkeys(page for match in matches for page in match.pages))
+        if matches and all(match.exact for match in matches) and len(candidate_pages) <= product_code_max_pages:
+            record(retrieval_path='product_code', product_codes=[match.code for match in matches])
+            return matches, candidate_pages, self._code_documents(sub_documents, matches, candidate_pages)
+        return matches, candidate_pages, None
+
+    def _boost(self, sub_documents, matches, candidate_pages, docs):
+        """
+        Puts the best pages of the matched designations first, followed by the hybrid search results on
+        pages mentioning them and then the remaining results.
+        """
+        if not matches:
+            return docs
+        record(retrieval_path='product_code_boost', product_codes=[match.code for match in matches])
+        # The best pages of every designation first, so each one is represented in the context
+        top_pages = list(dict.fromkeys(page for match in matches for page in match.pages[:product_code_max_pages]))
+        candidates = set(candidate_pages)
+        on_candidate_pages = [doc for doc in docs if doc.metadata['page_number'] in candidates]
+        others = [doc for doc in docs if doc.metadata['page_number'] not in candidates]
+        return self._code_documents(sub_documents, matches, top_pages) + on_candidate_pages + others
+
+    @staticmethod
+    def _code_documents(sub_documents, matches, pages):
+        """
+        Returns, for every page, the sub-documents on it that mention one of the matched designations.
+        """
+        codes = {match.indexed_code for match in matches}
+        docs = []
+        for page in pages:
+            rows = np.flatnonzero(np.asarray(sub_documents.page_numbers) == page)
+            page_docs = [sub_documents[int(row)] for row in rows]
+            mentioning = [doc for doc in page_docs if codes.intersection(extract_codes(doc.page_content))]
+            for doc in mentioning or page_docs[:1]:
+                doc.metadata['retrieval'] = 'product_code'
+                docs.append(doc)
+        return docs
+
+    def build_context(self, docs, query, prompt_template=RESPONSE_GENERATION_PROMPT):
+        """
+        Expands retrieved sub-documents into the page-level context passed to the LLM, deduplicated by page
+        and packed into the token budget left over by the prompt template and the query. Tables with more than
+        table_max_rows rows are reduced to their header and the rows relevant to the query.
+
+        Args:
+            docs (List[Document]): Retrieved sub-documents, best first.
+            query (str): The user query the prompt will be filled with.
+            prompt_template (str): The generation prompt template.
+
+        Returns:
+            PackedContext: The context string with one 'Page X:' section per page and its token counts.
+        """
+        with span('context_build'):
+            return pack_context(docs, self.page_map(query), context_token_budget(prompt_template, query))
+
+    def page_map(self, query):
+        """
+        Returns the page_number -> page_content mapping used for the context of a query, with the tables
+        reduced to the rows relevant to it.
+        """
+        with self._lock:
+            page_to_content, table_store = self.page_to_content, self.table_store
+        if table_max_rows is None:
+            return page_to_content
+        return SlicedPageMap(page_to_content, table_store, query, table_max_rows)
@@ -0,0 +1,351 @@
+import os
+import io
+import re
+import csv
+import json
+from product_codes import extract_query_codes
+from bm25_index import normalize_text
+from config import table_max_rows, k_value
+
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_MIN_TERM_LENGTH = 4
+# Query words are matched by their beginning, so inflected forms and compounds match ('dehnfugenabstande' - 'dehnfugenabstand')
+_TERM_PREFIX_LENGTH = 6
+
+
+def parse_csv(text):
+    """
+    Splits the CSV text of a table into rows of cell strings.
+    """
+    return list(csv.reader(io.StringIO(text)))
+
+
+def render_csv(rows):
+    """
+    Renders rows of cell strings as CSV text, in the format of DataFrame.to_csv(index=False).
+    """
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerows(rows)
+    return output.getvalue()
+
+
+def _code_patterns(query):
+    """
+    Returns, for every designation in the query, the patterns of the designation and its shorter
+    prefixes ('K-O-M4-V3', 'K-O-M4', 'K-O'), longest first.
+    """
+    patterns = []
+    for code in extract_query_codes(query):
+        segments = code.split('-')
+        variants = ['-'.join(segments[:end]) for end in range(len(segments), min(2, len(segments)) - 1, -1)]
+        # A designation also matches its longer variants in the table, 'K-O' matches 'K-O-M4'
+        patterns.append([re.compile(rf"(?<![\w-]){re.escape(variant)}(?![A-Z0-9])") for variant in variants])
+    return patterns
+
+
+def _row_texts(rows):
+    """
+    Returns the uppercased and the normalized text of every row, as matched by select_rows().
+    """
+    upper_rows = [' '.join(row).upper() for row in rows]
+    return upper_rows, [normalize_text(text) for text in upper_rows]
+
+
+def select_rows(rows, query, max_rows=table_max_rows, row_texts=None):
+    """
+    Selects the rows of a table that are relevant to a query.
+
+    A row scores two points for every designation of the query it mentions (or, if no row mentions a
+    designation, its longest prefix that some row mentions) and one point for every query word it contains.
+    Words contained in more than half of the rows do not discriminate and are ignored.
+
+    Args:
+        rows (List[List[str]]): The data rows of the table, without the header.
+        query (str): The user query.
+        max_rows (int): Maximum number of rows selected.
+        row_texts (tuple, optional): The row texts from _row_texts(), if already computed.
+
+    Returns:
+        List[int] or None: Indices of the selected rows in table order, or None if no row matches
+        and the table should be kept whole.
+    """
+    upper_rows, normalized_rows = row_texts or _row_texts(rows)
+    scores = [0] * len(rows)
+
+    for variants in _code_patterns(query):
+        for pattern in variants:
+            matched = [index for index, text in enumerate(upper_rows) if pattern.search(text)]
+            if matched:
+                for index in matched:
+                    scores[index] += 2
+                break
+
+    terms = {word[:_TERM_PREFIX_LENGTH] for word in _WORD_RE.findall(normalize_text(query)) if len(word) >= _MIN_TERM_LENGTH}
+    for term in terms:
+        matched = [index for index, text in enumerate(normalized_rows) if term in text]
+        if len(matched) <= len(rows) / 2:
+            for index in matched:
+                scores[index] += 1
+
+    ranked = sorted((index for index, score in enumerate(scores) if score > 0), key=lambda index: (-scores[index], index))
+    return sorted(ranked[:max_rows]) if ranked else None
+
+
+class TableStore:
+    """
+    Columnar store of the tables extracted from the manual, keyed by '<page number>:<table index on the page>'.
+
+    Every table is kept as its header and one list of cell values per column, as rendered in the CSV text of
+    its sub-document and page, so the full table can be reproduced exactly. At answer time slice() reduces a
+    table to the header and the rows relevant to the query, and SlicedPageMap replaces the full tables in the
+    page content with these slices.
+
+    Args:
+        tables (dict): Mapping from key to {'page_number', 'table_index', 'header', 'columns'}.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        # Rendered CSV and row texts, computed once per table on first use
+        self._cache = {}
+        self._page_tables = {}
+        for key, table in tables.items():
+            self._page_tables.setdefault(table['page_number'], []).append(key)
+
+    @classmethod
+    def build(cls, tables):
+        """
+        Builds the store from the CSV text of the extracted tables.
+
+        Args:
+            tables (Iterable[Tuple[int, str]]): Page number and CSV text of every table, in document order.
+
+        Returns:
+            TableStore: The built store.
+        """
+        store, table_counts = {}, {}
+        for page_number, text in tables:
+            table_index = table_counts.get(page_number, 0)
+            table_counts[page_number] = table_index + 1
+            rows = parse_csv(text)
+            if not rows:
+                continue
+            header, body = rows[0], rows[1:]
+            store[f"{page_number}:{table_index}"] = {
+                'page_number': page_number,
+                'table_index': table_index,
+                'header': header,
+                'columns': [[row[column] if column < len(row) else '' for row in body] for column in range(len(header))],
+            }
+        return cls(store)
+
+    @classmethod
+    def from_sub_documents(cls, sub_documents):
+        """
+        Builds the store from the table sub-documents, e.g. of a document store written before tables were stored.
+
+        Args:
+            sub_documents (List[Document] or DocumentStore): The sub-documents.
+
+        Returns:
+            TableStore: The built store.
+        """
+        return cls.build((doc.metadata['page_number'], doc.page_content) for doc in sub_documents
+                         if doc.metadata.get('element_type') == 'table')
+
+    def save(self, path):
+        """
+        Writes the store as JSON.
+
+        Args:
+            path (str): Path of the JSON file.
+        """
+        with open(f"{path}.tmp", 'w') as json_file:
+            json.dump(self.tables, json_file, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a store written by save().
+
+        Args:
+            path (str): Path of the JSON file.
+
+        Returns:
+            TableStore: The loaded store.
+        """
+        with open(path, 'r') as json_file:
+            return cls(json.load(json_file))
+
+    def __len__(self):
+        return len(self.tables)
+
+    def page_tables(self, page_number):
+        """
+        Returns the keys of the tables on a page, in page order.
+        """
+        return self._page_tables.get(page_number, [])
+
+    def num_rows(self, key):
+        """
+        Returns the number of data rows of a table.
+        """
+        columns = self.tables[key]['columns']
+        return len(columns[0]) if columns else 0
+
+    def rows(self, key):
+        """
+        Returns the data rows of a table, without the header.
+        """
+        return [list(row) for row in zip(*self.tables[key]['columns'])]
+
+    def _cached(self, key):
+        cached = self._cache.get(key)
+        if cached is None:
+            rows = self.rows(key)
+            cached = (rows, render_csv([self.tables[key]['header'], *rows]), _row_texts(rows))
+            self._cache[key] = cached
+        return cached
+
+    def to_csv(self, key):
+        """
+        Returns the full table as CSV text, as it appears in its page.
+        """
+        return self._cached(key)[1]
+
+    def slice(self, key, query, max_rows=table_max_rows):
+        """
+        Returns the header and the rows of a table relevant to a query as CSV text.
+
+        Args:
+            key (str): The table key.
+            query (str): The user query.
+            max_rows (int): Maximum number of rows kept.
+
+        Returns:
+            str: The sliced table, followed by a note on the omitted rows, or the full table if it has at most
+            max_rows rows or no row matches the query.
+        """
+        rows, full_csv, row_texts = self._cached(key)
+        selected = select_rows(rows, query, max_rows, row_texts) if len(rows) > max_rows else None
+        if selected is None:
+            return full_csv
+        return (render_csv([self.tables[key]['header'], *(rows[index] for index in selected)])
+                + f"({len(selected)} of {len(rows)} rows shown)\n")
+
+
+class SlicedPageMap:
+    """
+    page_number -> page_content mapping that replaces the full tables of every page with their rows relevant to a query.
+
+    It can be passed wherever a page map from data_prep.build_page_map is expected.
+
+    Args:
+        page_to_content (dict): The underlying page map.
+        table_store (TableStore): The tables of the pages.
+        query (str): The user query.
+        max_rows (int): Maximum number of rows kept per table.
+    """
+
+    def __init__(self, page_to_content, table_store, query, max_rows=table_max_rows):
+        self.page_to_content = page_to_content
+        self.table_store = table_store
+        self.query = query
+        self.max_rows = max_rows
+        self._pages = {}
+
+    def __contains__(self, page_number):
+        return page_number in self.page_to_content
+
+    def __getitem__(self, page_number):
+        content = self._pages.get(page_number)
+        if content is None:
+            content = self.page_to_content[page_number]
+            for key in self.table_store.page_tables(page_number):
+                if self.table_store.num_rows(key) > self.max_rows:
+                    # A table whose text is not found verbatim, e.g. of a stale store, is left as it is
+                    content = content.replace(self.table_store.to_csv(key), self.table_store.slice(key, self.query, self.max_rows), 1)
+            self._pages[page_number] = content
+        return content
+
+    def get(self, page_number, default=None):
+        return self[page_number] if page_number in self else default
+
+
+def open_table_store(path, sub_documents):
+    """
+    Loads the table store, building and saving it from the table sub-documents first if it does not exist.
+
+    Args:
+        path (str): Path of the JSON file.
+        sub_documents (List[Document] or DocumentStore): The sub-documents.
+
+    Returns:
+        TableStore: The store.
+    """
+    if os.path.exists(path):
+        return TableStore.load(path)
+    table_store = TableStore.from_sub_documents(sub_documents)
+    table_store.save(path)
+    print(f"Table store with {len(table_store)} tables saved at {path}")
+    return table_store
+
+
+def measure_table_slicing(csv_file_path='questions_answers.csv', k=k_value, query_engine=None):
+    """
+    Compares the context tokens of full tables against sliced tables on the evaluation questions.
+
+    Both contexts are built from the same retrieved pages without a token budget, so the difference is
+    only due to the table slicing. Without a query_engine the configured stores and embeddings are used,
+    which is refused while benchmark.py's stand-ins are installed: their retrieval does not reflect the
+    production pages, so the figures would not either.
+
+    Args:
+        csv_file_path (str): CSV file with the evaluation queries in the 'Frage' column.
+        k (int): Number of chunks retrieved from the vector store.
+        query_engine (QueryEngine, optional): The engine to retrieve with, defaults to one over the configured stores.
+
+    Returns:
+        dict: Total context tokens with full and with sliced tables, over all questions and over the
+        questions whose context contained a sliced table, and the tokenizer the tokens were counted with.
+    """
+    # Imported here, query_engine imports this module
+    import pandas as pd
+    from query_engine import QueryEngine
+    from context_builder import pack_context, token_counter_name
+    from providers import resolved_provider
+
+    if query_engine is None and resolved_provider('embeddings') is None:
+        raise ValueError("Local stand-in embeddings are installed, pass the query_engine to measure with explicitly")
+
+    data = pd.read_csv(csv_file_path)
+    data.columns = data.columns.str.strip()
+    queries = data['Frage'].tolist()
+    query_engine = query_engine or QueryEngine()
+
+    totals = {'full_tokens': 0, 'sliced_tokens': 0, 'table_questions': 0, 'table_full_tokens': 0, 'table_sliced_tokens': 0,
+              'tokenizer': token_counter_name()}
+    for query, docs in zip(queries, query_engine.retrieve_many(queries, k=k)):
+        full = pack_context(docs, query_engine.page_to_content, float('inf'))
+        sliced = pack_context(docs, SlicedPageMap(query_engine.page_to_content, query_engine.table_store, query), float('inf'))
+        totals['full_tokens'] += full.tokens
+        totals['sliced_tokens'] += sliced.tokens
+        if sliced.tokens < full.tokens:
+            totals['table_questions'] += 1
+            totals['table_full_tokens'] += full.tokens
+            totals['table_sliced_tokens'] += sliced.tokens
+
+    def reduction(full_tokens, sliced_tokens):
+        return f"{(1 - sliced_tokens / full_tokens) * 100:.1f}%" if full_tokens else "n/a"
+
+    print(f"{len(queries)} questions, tokens counted with {totals['tokenizer']}: {totals['full_tokens']} context tokens with full tables, "
+          f"{totals['sliced_tokens']} with sliced tables ({reduction(totals['full_tokens'], totals['sliced_tokens'])} fewer)")
+    print(f"{totals['table_questions']} questions with sliced tables: {totals['table_full_tokens']} -> "
+          f"{totals['table_sliced_tokens']} tokens ({reduction(totals['table_full_tokens'], totals['table_sliced_tokens'])} fewer)")
+    return totals
+
+
+if __name__ == '__main__':
+    measure_table_slicing()
@@ -0,0 +1,42 @@
+from product_codes import ProductCodeIndex, extract_query_codes
+
+
+def make_index():
+    return ProductCodeIndex({'K-O': {23: 2, 24: 1}, 'K': {5: 1}, 'Q': {7: 1}, 'H-NN1': {184: 1, 185: 1}}, num_docs=5)
+
+
+def test_variant_resolves_to_longest_indexed_prefix():
+    assert extract_query_codes("Gibt es die Isokorb K-O-M4-V3?") == ['K-O-M4-V3']
+    [match] = make_index().lookup("Gibt es die Isokorb K-O-M4-V3?")
+    assert (match.indexed_code, match.pages) == ('K-O', [23, 24])
+    assert not match.exact
+
+
+def test_type_designation():
+    assert extract_query_codes("Welche Tragstufen gibt es für Typ K?") == ['K']
+    [match] = make_index().lookup("Welche Tragstufen gibt es für Typ K?")
+    assert match.exact and match.pages == [5]
+
+
+def test_lowercase_designation():
+    assert extract_query_codes("Dehnfugenabstand für h-nn1") == ['H-NN1']
+    [match] = make_index().lookup("Dehnfugenabstand für h-nn1")
+    assert match.indexed_code == 'H-NN1'
+
+
+def test_hyphenated_word_is_not_a_designation():
+    assert extract_query_codes("Ist der K-Wert relevant?") == []
+    assert extract_query_codes("Welche Q-Werte sind zulässig?") == []
+    assert make_index().lookup("Ist der K-Wert relevant?") == []
+
+
+def test_norm_reference_is_not_a_designation():
+    assert extract_query_codes("Gilt die Bemessung nach EN 1992-1-1?") == []
+
+
+def test_prefix_fallback_stops_at_two_segments():
+    index = make_index()
+    assert index.resolve('K-WERT') is None
+    assert index.resolve('K-WERT', min_segments=1) == 'K'
+    assert index.resolve('K-O-M4') == 'K-O'
+    assert index.resolve('Q') == 'Q'
@@ -0,0 +1,235 @@
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+from typing import Any, List
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from config import tracing_enabled, trace_path
+
+
+_NULL_SPAN = nullcontext()
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """
+    Wall time per pipeline stage and counters (tokens, context size, retries) of a single request.
+
+    Repeated stages, such as several LLM attempts, are summed. Code deeper in the pipeline records into the
+    trace that is active in the current thread through the module level span() and record() functions.
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.stages = {}
+        self.fields = dict(fields)
+        self.start_time = time.perf_counter()
+        self.total = None
+
+    @contextmanager
+    def span(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start_time
+
+    def record(self, **fields):
+        self.fields.update(fields)
+
+    def increment(self, field, amount=1):
+        self.fields[field] = self.fields.get(field, 0) + amount
+
+    def to_dict(self):
+        stages_ms = {stage: round(seconds * 1000, 3) for stage, seconds in self.stages.items()}
+        # Without an explicit fusion stage, the legs ran one after the other and the rest of the retrieval time is fusion
+        if {'retrieval', 'bm25', 'vector_search'} <= stages_ms.keys() and 'fusion' not in stages_ms:
+            stages_ms['fusion'] = round(max(0.0, stages_ms['retrieval'] - stages_ms['bm25'] - stages_ms['vector_search']), 3)
+        if self.total is not None:
+            stages_ms['total'] = round(self.total * 1000, 3)
+        return {'name': self.name, 'timestamp': time.time(), 'stages_ms': stages_ms, **self.fields}
+
+
+class _NullTrace:
+    """
+    Stand-in used when tracing is disabled; every operation is a no-op.
+    """
+
+    def span(self, stage):
+        return _NULL_SPAN
+
+    def record(self, **fields):
+        pass
+
+    def increment(self, field, amount=1):
+        pass
+
+    def to_dict(self):
+        return {}
+
+
+NULL_TRACE = _NullTrace()
+
+
+class Tracer:
+    """
+    Creates request traces and exports the finished ones as JSON lines.
+
+    When disabled, trace() hands out a shared no-op trace, so instrumented code costs one attribute lookup
+    and one function call per stage.
+
+    Args:
+        enabled (bool): Whether traces are recorded.
+        export_path (str, optional): JSON lines file every finished trace is appended to.
+    """
+
+    def __init__(self, enabled=False, export_path=None):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.traces = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, name, **fields):
+        """
+        Activates a new trace for the current thread for the duration of the block.
+
+        Args:
+            name (str): Name of the traced operation, e.g. 'query' or 'evaluate'.
+            **fields: Fields stored with the trace, e.g. the query.
+
+        Yields:
+            Trace: The active trace, or a no-op trace when tracing is disabled.
+        """
+        if not self.enabled:
+            yield NULL_TRACE
+            return
+        trace = Trace(name, **fields)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            trace.total = time.perf_counter() - trace.start_time
+            self._finish(trace)
+
+    def _finish(self, trace):
+        with self._lock:
+            self.traces.append(trace)
+            if self.export_path:
+                with open(self.export_path, 'a') as trace_file:
+                    trace_file.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+
+    def summary(self, name=None):
+        """
+        Computes p50 and p95 wall time per stage over the finished traces.
+
+        Args:
+            name (str, optional): Only include traces with this name.
+
+        Returns:
+            dict: Mapping from stage to {'p50': ms, 'p95': ms, 'count': n}.
+        """
+        with self._lock:
+            traces = [trace.to_dict() for trace in self.traces if name is None or trace.name == name]
+        per_stage = {}
+        for trace in traces:
+            for stage, ms in trace['stages_ms'].items():
+                per_stage.setdefault(stage, []).append(ms)
+        return {stage: {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)), 'count': len(values)}
+                for stage, values in per_stage.items()}
+
+
+tracer = Tracer(enabled=tracing_enabled, export_path=trace_path)
+
+
+def current_trace():
+    """
+    Returns the trace active in the current thread, or the no-op trace.
+    """
+    trace = _current_trace.get()
+    return trace if trace is not None else NULL_TRACE
+
+
+def span(stage):
+    """
+    Times a stage of the trace active in the current thread.
+
+    Args:
+        stage (str): Name of the stage, e.g. 'bm25' or 'llm'.
+    """
+    trace = _current_trace.get()
+    return trace.span(stage) if trace is not None else _NULL_SPAN
+
+
+def record(**fields):
+    """
+    Stores counters such as token counts or context size in the trace active in the current thread.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(**fields)
+
+
+def record_usage(response):
+    """
+    Stores the prompt and completion token counts reported with an LLM response, if any.
+
+    Args:
+        response: An AIMessage or AIMessageChunk.
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    if usage:
+        record(prompt_tokens=usage.get('input_tokens'), completion_tokens=usage.get('output_tokens'))
+
+
+class TracedRetriever(BaseRetriever):
+    """
+    Wraps a retriever so that its invocations are timed as a stage of the active trace.
+    """
+
+    retriever: Any
+    stage: str
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with span(self.stage):
+            return self.retriever.invoke(query)
+
+
+class TracedEmbeddings(Embeddings):
+    """
+    Wraps an embedding function so that query embedding is timed as the 'query_embedding' stage.
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with span('query_embedding'):
+            return self.embeddings.embed_query(text)
+
+    def __getattr__(self, name):
+        # Forward extras of the wrapped function, e.g. CachedEmbeddings.stats
+        return getattr(self.embeddings, name)
+
+
+def traced_retriever(retriever, stage):
+    """
+    Returns the retriever wrapped in a TracedRetriever, or unchanged when tracing is disabled.
+    """
+    return TracedRetriever(retriever=retriever, stage=stage) if tracer.enabled else retriever
+
+
+def traced_embeddings(embeddings):
+    """
+    Returns the embedding function wrapped in TracedEmbeddings, or unchanged when tracing is disabled.
+    """
+    return TracedEmbeddings(embeddings) if tracer.enabled else embeddings
@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import argparse
+from typing import Any, List
+import numpy as np
+import pandas as pd
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from config import text_embeddings, vector_backend, vector_store_path, flat_index_path, embedding_batch_size, k_value
+
+
+# Candidates scoring within this margin of the k-th best are rescored exactly before ranking
+_RESCORE_MARGIN = 1e-4
+
+
+def _normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class FlatVectorIndex:
+    """
+    Exact in-process vector index over a memory-mapped float32 matrix of normalized embeddings.
+
+    For a corpus of a few thousand chunks, brute force is both exact and faster than an HNSW index:
+    a query is answered with a single matrix-vector product and a batch of queries with a single
+    matrix-matrix product. The index files are written by indexing.py:
+    'vectors.npy' (one normalized embedding per row) and 'documents.json' (content, metadata and ID per row).
+
+    Args:
+        vectors (np.ndarray): Normalized embeddings, one row per document.
+        documents (Sequence[Document]): The documents, in the order of the rows, e.g. a list or a lazy view of a DocumentStore.
+        ids (List[str]): The chunk IDs, in the order of the rows.
+        embeddings (Embeddings): Embedding function used for queries.
+    """
+
+    def __init__(self, vectors, documents, ids, embeddings=text_embeddings):
+        self.vectors = vectors
+        self.documents = documents
+        self.ids = ids
+        self.embeddings = embeddings
+
+    @classmethod
+    def build(cls, documents, ids, embeddings=text_embeddings, batch_size=embedding_batch_size):
+        """
+        Embeds documents and builds the index.
+
+        The documents are read one batch at a time and kept as given, so a lazy sequence such as a
+        DocumentStore is never materialized; only the embedding matrix is held in memory.
+
+        Args:
+            documents (Sequence[Document]): The documents to index, e.g. a DocumentStore.
+            ids (List[str]): Stable chunk IDs of the documents.
+            embeddings (Embeddings): Embedding function, the embedding cache makes unchanged chunks free.
+            batch_size (int): Number of documents embedded per request.
+
+        Returns:
+            FlatVectorIndex: The built index.
+        """
+        batches, texts = [], []
+        for doc in documents:
+            texts.append(doc.page_content)
+            if len(texts) == batch_size:
+                batches.append(_normalize_rows(embeddings.embed_documents(texts)))
+                texts = []
+        if texts:
+            batches.append(_normalize_rows(embeddings.embed_documents(texts)))
+        vectors = np.concatenate(batches) if batches else np.zeros((0, 0), dtype=np.float32)
+        return cls(vectors, documents, ids, embeddings)
+
+    @classmethod
+    def from_chroma(cls, vectordb, embeddings=text_embeddings):
+        """
+        Builds the index from the embeddings already stored in a Chroma collection, without re-embedding.
+
+        Args:
+            vectordb (Chroma): The Chroma vector store.
+            embeddings (Embeddings): Embedding function used for queries.
+
+        Returns:
+            FlatVectorIndex: The built index.
+        """
+        data = vectordb.get(include=['embeddings', 'documents', 'metadatas'])
+        documents = [Document(page_content=text, metadata=metadata or {})
+                     for text, metadata in zip(data['documents'], data['metadatas'])]
+        return cls(_normalize_rows(data['embeddings']), documents, list(data['ids']), embeddings)
+
+    def save(self, path):
+        """
+        Writes the index to a directory.
+
+        Args:
+            path (str): Directory where the index files are written.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'vectors.npy'), np.asarray(self.vectors, dtype=np.float32))
+        # Written row by row, so documents backed by a store are decoded one at a time
+        with open(os.path.join(path, 'documents.json'), 'w') as json_file:
+            json_file.write('[')
+            for row, (chunk_id, doc) in enumerate(zip(self.ids, self.documents)):
+                if row:
+                    json_file.write(', ')
+                json.dump({'id': chunk_id, 'page_content': doc.page_content, 'metadata': doc.metadata}, json_file)
+            json_file.write(']')
+
+    @classmethod
+    def load(cls, path, embeddings=text_embeddings):
+        """
+        Loads an index written by save(), memory-mapping the embedding matrix.
+
+        Args:
+            path (str): Directory containing the index files.
+            embeddings (Embeddings): Embedding function used for queries.
+
+        Returns:
+            FlatVectorIndex: The loaded index.
+        """
+        vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'documents.json'), 'r') as json_file:
+            rows = json.load(json_file)
+        documents = [Document(page_content=row['page_content'], metadata=row['metadata']) for row in rows]
+        return cls(vectors, documents, [row['id'] for row in rows], embeddings)
+
+    def search_by_vectors(self, query_vectors, k):
+        """
+        Finds the k most similar documents for each of a batch of query embeddings.
+
+        Args:
+            query_vectors (array-like): Query embeddings, one row per query.
+            k (int): Number of documents per query.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Row indices and cosine similarities, each of shape (queries, k), best first.
+            Equal similarities are ordered by row index.
+        """
+        query_matrix = _normalize_rows(np.atleast_2d(query_vectors))
+        # One matrix-matrix product scores every document against every query
+        scores = query_matrix @ self.vectors.T
+        k = min(k, scores.shape[1])
+        results = [self._rescore_top_k(query, query_scores, k) for query, query_scores in zip(query_matrix, scores)]
+        return np.array([rows for rows, _ in results]), np.array([similarities for _, similarities in results])
+
+    def _rescore_top_k(self, query, scores, k):
+        # BLAS rounds differently depending on the number of queries in the product, so the candidates near
+        # the k-th score are rescored row by row; the ranking then does not depend on the batch size
+        threshold = np.partition(scores, scores.size - k)[scores.size - k] - _RESCORE_MARGIN
+        candidates = np.flatnonzero(scores >= threshold)
+        exact = np.sum(np.asarray(self.vectors[candidates], dtype=np.float64) * query.astype(np.float64), axis=1)
+        order = np.lexsort((candidates, -exact))[:k]
+        return candidates[order], exact[order].astype(np.float32)
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        """
+        Returns the k documents most similar to a query embedding, like Chroma.similarity_search_by_vector.
+        """
+        rows, _ = self.search_by_vectors(embedding, k)
+        return [self.documents[row] for row in rows[0]]
+
+    def similarity_search(self, query, k=4):
+        """
+        Returns the k documents most similar to a query, like Chroma.similarity_search.
+        """
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k)
+
+    def as_retriever(self, search_kwargs=None):
+        """
+        Wraps the index in a LangChain retriever, like Chroma.as_retriever, so it can be used in an EnsembleRetriever.
+        """
+        return FlatVectorRetriever(index=self, k=(search_kwargs or {}).get('k', 4))
+
+
+class FlatVectorRetriever(BaseRetriever):
+    """
+    LangChain retriever over a FlatVectorIndex.
+    """
+
+    index: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.index.similarity_search(query, self.k)
+
+
+def load_vector_store(backend=vector_backend, embeddings=text_embeddings, path=None):
+    """
+    Opens the vector store selected by config.vector_backend.
+
+    Both backends provide as_retriever(search_kwargs={"k": k}) and similarity_search_by_vector(embedding, k).
+
+    Args:
+        backend (str): 'chroma' for the persistent Chroma store, 'flat' for the in-process NumPy index.
+        embeddings (Embeddings): Embedding function used for queries.
+        path (str, optional): Directory of the store, defaults to config.vector_store_path or config.flat_index_path.
+
+    Returns:
+        Chroma or FlatVectorIndex: The vector store.
+    """
+    if backend == 'chroma':
+        # Imported on demand, the Chroma client is the slowest import of the pipeline
+        from langchain_chroma import Chroma
+        return Chroma(persist_directory=path or vector_store_path, embedding_function=embeddings)
+    if backend == 'flat':
+        return FlatVectorIndex.load(path or flat_index_path, embeddings)
+    raise ValueError(f"Unknown vector backend '{backend}', expected 'chroma' or 'flat'")
+
+
+def synthetic_backends(num_chunks=1624, num_queries=34, dim=64, seed=0):
+    """
+    Builds an in-memory Chroma collection and a flat index over the same random normalized vectors.
+
+    Lets compare_backends() run without the indexed manual or any embedding API. The defaults match the
+    sub-documents of the manual and the evaluation queries; every chunk gets its own content.
+
+    Args:
+        num_chunks (int): Number of indexed vectors.
+        num_queries (int): Number of query vectors.
+        dim (int): Dimension of the vectors.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        Tuple[Chroma, FlatVectorIndex, List[List[float]]]: The Chroma store, the flat index and the query vectors.
+    """
+    import chromadb
+    from langchain_chroma import Chroma
+    rng = np.random.default_rng(seed)
+    vectors = _normalize_rows(rng.standard_normal((num_chunks, dim)))
+    query_vectors = _normalize_rows(rng.standard_normal((num_queries, dim))).tolist()
+    ids = [f"chunk-{row}" for row in range(num_chunks)]
+    documents = [Document(page_content=f"chunk {row}", metadata={'page_number': row // 8 + 1}) for row in range(num_chunks)]
+
+    client = chromadb.EphemeralClient()
+    collection = client.create_collection('synthetic')
+    for start in range(0, num_chunks, embedding_batch_size):
+        collection.add(ids=ids[start:start + embedding_batch_size],
+                       embeddings=vectors[start:start + embedding_batch_size].tolist(),
+                       documents=[doc.page_content for doc in documents[start:start + embedding_batch_size]],
+                       metadatas=[doc.metadata for doc in documents[start:start + embedding_batch_size]])
+    vectordb = Chroma(client=client, collection_name='synthetic')
+    return vectordb, FlatVectorIndex(vectors, documents, ids, embeddings=None), query_vectors
+
+
+def compare_backends(csv_file_path='questions_answers.csv', k=k_value, repeats=20, synthetic=False):
+    """
+    Compares search latency and recall of the Chroma HNSW store against the exact flat index.
+
+    Both backends search with the same query embeddings, so only the search itself is timed. Recall@k
+    of Chroma is measured against the exact top-k of the flat index built from the same vectors.
+
+    Args:
+        csv_file_path (str): CSV file with the evaluation queries in the 'Frage' column.
+        k (int): Number of results per query.
+        repeats (int): Number of timed repetitions over all queries.
+        synthetic (bool): Compare on random vectors from synthetic_backends() instead of the indexed manual.
+    """
+    if synthetic:
+        vectordb, flat_index, query_vectors = synthetic_backends()
+    else:
+        data = pd.read_csv(csv_file_path)
+        data.columns = data.columns.str.strip()
+        queries = data['Frage'].tolist()
+
+        vectordb = load_vector_store('chroma', text_embeddings)
+        flat_index = FlatVectorIndex.from_chroma(vectordb)
+        query_vectors = [text_embeddings.embed_query(query) for query in queries]
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        chroma_results = [vectordb.similarity_search_by_vector(vector, k=k) for vector in query_vectors]
+    chroma_ms = (time.perf_counter() - start_time) * 1000 / (repeats * len(query_vectors))
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        flat_results = [flat_index.search_by_vectors(vector, k)[0][0] for vector in query_vectors]
+    flat_ms = (time.perf_counter() - start_time) * 1000 / (repeats * len(query_vectors))
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        flat_index.search_by_vectors(query_vectors, k)
+    flat_batch_ms = (time.perf_counter() - start_time) * 1000 / (repeats * len(query_vectors))
+
+    # Match by chunk ID, the manual has chunks with identical content on the same page
+    recalls = []
+    for chroma_docs, exact_rows in zip(chroma_results, flat_results):
+        found = {doc.id for doc in chroma_docs}
+        exact = {flat_index.ids[row] for row in exact_rows}
+        recalls.append(len(found & exact) / len(exact))
+
+    source = "synthetic vectors" if synthetic else "indexed manual"
+    print(f"{len(query_vectors)} queries, {len(flat_index.documents)} chunks ({source}), k={k}")
+    print(f"Chroma (HNSW):       {chroma_ms:.3f} ms/query, recall@{k} {np.mean(recalls):.3f}")
+    print(f"Flat (single query): {flat_ms:.3f} ms/query, recall@{k} 1.000")
+    print(f"Flat (batched):      {flat_batch_ms:.3f} ms/query")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare search latency and recall of the Chroma and flat vector backends.")
+    parser.add_argument('--synthetic', action='store_true', help="Use random normalized 64-d vectors instead of the indexed manual.")
+    parser.add_argument('--k', type=int, default=k_value, help="Number of results per query.")
+    parser.add_argument('--repeats', type=int, default=20, help="Number of timed repetitions over all queries.")
+    args = parser.parse_args()
+    compare_backends(k=args.k, repeats=args.repeats, synthetic=args.synthetic)